@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+A stand-in for pdflatex, so the benchmarks run without TeX.
+
+It accepts the options used by python-latex, sleeps for a configurable
+time, writes <jobname>.pdf/.aux/.log and prints the "Output written on"
+line.  A document with \\ref or \\pageref commands asks for one rerun,
+like LaTeX does when its labels have changed.  Configuration, from the
+environment:
+
+    FAKE_PDFLATEX_LATENCY   seconds per pass (default 0.05)
+    FAKE_PDFLATEX_PAGES     pages reported (default: 1 + \\newpage count)
+    FAKE_PDFLATEX_BYTES     size of the PDF written (default 4096)
+"""
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+import sys
+import time
+
+
+def main(argv):
+    jobname = None
+    ini = False
+    filenames = []
+    for arg in argv:
+        if arg.startswith('-jobname='):
+            jobname = arg.split('=', 1)[1]
+        elif arg == '-ini':
+            ini = True
+        elif arg.startswith('-') or arg.startswith('&'):
+            pass
+        else:
+            filenames.append(arg)
+    src = filenames[-1]
+    if jobname is None:
+        jobname = os.path.splitext(os.path.basename(src))[0]
+    time.sleep(float(os.environ.get('FAKE_PDFLATEX_LATENCY', '0.05')))
+    with open(src, 'rb') as f:
+        text = f.read()
+    if ini:
+        with open(jobname + '.fmt', 'wb') as f:
+            f.write(text)
+        print('Beginning to dump on file %s.fmt' % jobname)
+        return 0
+
+    aux = '\\relax\n' + '\\newlabel{}\n' * min(1, text.count(b'ref{'))
+    old_aux = None
+    if os.path.exists(jobname + '.aux'):
+        with open(jobname + '.aux') as f:
+            old_aux = f.read()
+    with open(jobname + '.aux', 'w') as f:
+        f.write(aux)
+    if old_aux != aux and '\\newlabel' in aux:
+        print('LaTeX Warning: Label(s) may have changed. '
+              'Rerun to get cross-references right.')
+
+    pages = int(os.environ.get('FAKE_PDFLATEX_PAGES',
+                               text.count(b'\\newpage') + 1))
+    size = int(os.environ.get('FAKE_PDFLATEX_BYTES', '4096'))
+    header = b'%PDF-1.4\n% ' + hashlib.sha1(text).hexdigest().encode() + b'\n'
+    with open(jobname + '.pdf', 'wb') as f:
+        f.write(header + b'\0' * max(0, size - len(header)))
+    with open(jobname + '.log', 'w') as f:
+        f.write('fake pdflatex\n')
+    print('Output written on %s.pdf (%d page%s, %d bytes).' % (
+        jobname, pages, '' if pages == 1 else 's', max(size, len(header))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Benchmarks for python-latex.
+
+    python benchmarks/run.py [--repeat N] [--latency SECONDS]
+                             [--only NAME ...] [--output FILE]
+                             [--compare OLD.json]
+
+Compiles run against benchmarks/fake_pdflatex.py, so no TeX installation
+is needed; --latency sets the time each fake pass takes.  The view
+benchmark runs under benchmarks/settings.py, and is skipped if Django
+is not installed.
+
+Results are written as JSON (to stdout, or --output): for each
+benchmark, the min/median/mean seconds per run over --repeat runs.
+With --compare, the ratio to an earlier result file is also reported
+on stderr, to spot regressions between commits.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from latex import latex_calendar
+from latex.latex_document import DocumentTemplate, LaTeX_Document, compile_many
+from latex.utils import latex_fixes, safe_text_specials
+
+FAKE_PDFLATEX = os.path.join(BENCH_DIR, 'fake_pdflatex.py')
+
+#######################
+
+BENCHMARKS = []
+
+
+class Skip(Exception):
+    """
+    Raised by a benchmark that cannot run here; the message says why.
+    """
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def table_body(rows):
+    return ''.join(u'%d & %s. See p.~\\pageref{end}. \\\\\n' % (
+        i, safe_text_specials(u'Item_%d costs $%d & 10%% off #%d' % (i, i, i)))
+        for i in range(rows))
+
+
+@benchmark
+def render_src():
+    for i in range(1000):
+        doc = LaTeX_Document(u'Body %d' % i, title=u'Title', author=u'Author',
+                             packages={'amsmath': '', 'geometry': 'margin=1in',
+                                       'graphicx': ''})
+        doc.render_src()
+
+
+@benchmark
+def document_template():
+    template = DocumentTemplate(title=u'Title', author=u'Author',
+                                packages={'amsmath': '', 'geometry': 'margin=1in',
+                                          'graphicx': ''})
+    for i in range(1000):
+        template.document(u'Body %d' % i).render_src()
+
+
+@benchmark
+def safe_text_specials_cells():
+    cells = [u'Cell_%d: $%d & 50%% off {#%d} ~^\\' % (i, i, i)
+             for i in range(20000)]
+    for cell in cells:
+        safe_text_specials(cell)
+
+
+@benchmark
+def latex_fixes_document():
+    latex_fixes(table_body(20000).replace(u'&', u'&#39;', 1000))
+
+
+@benchmark
+def calendar_main():
+    latex_calendar.main(list(range(1950, 2050)))
+
+
+@benchmark
+def compile_document():
+    doc = LaTeX_Document(table_body(100))
+    assert doc.compile(), doc.log
+    doc.cleanup()
+
+
+@benchmark
+def compile_many_concurrent():
+    # a stress test of concurrent compiles in one process, too: every
+    # document must come back with its own output.
+    docs = [LaTeX_Document(u'Document %d\n' % i + table_body(10))
+            for i in range(32)]
+    for result in compile_many(docs, max_workers=8):
+        assert result.result and result.error is None, result.log
+        assert result.document.pdf_data() is not None
+    digests = set(doc.pdf_data().split(b'\n')[1] for doc in docs)
+    assert len(digests) == len(docs)
+    for doc in docs:
+        doc.cleanup()
+
+
+# the Django view, set up on first use; see setup_django().
+_django_view = None
+
+
+def setup_django():
+    """
+    Set up Django (once) and return (request_factory, view).
+    """
+    global _django_view
+    if _django_view is not None:
+        return _django_view
+    try:
+        import django
+    except ImportError:
+        raise Skip('Django is not installed')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    sys.path.insert(0, BENCH_DIR)
+    django.setup()
+    from django.test import RequestFactory
+    from latex.djangoviews import LaTeXListView
+
+    class ListView(LaTeXListView):
+        template_name = 'list.tex'
+
+        def get_queryset(self):
+            return [(i, u'Row %d' % i) for i in range(2000)]
+
+    _django_view = RequestFactory(), ListView.as_view()
+    return _django_view
+
+
+@benchmark
+def render_to_response():
+    factory, view = setup_django()
+    response = view(factory.get('/'))
+    assert response.status_code == 200
+    b''.join(response.streaming_content)
+    response.close()
+
+
+#######################
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(func, repeat):
+    func()  # warm up
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'repeat': repeat,
+    }
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        old = json.load(f)['benchmarks']
+    for name, result in sorted(results.items()):
+        if 'median' not in result or 'median' not in old.get(name, {}):
+            continue
+        ratio = result['median'] / old[name]['median']
+        flag = '  <-- slower' if ratio > 1.1 else ''
+        print('%-28s %8.4fs  x%.2f%s' % (name, result['median'], ratio, flag),
+              file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='python-latex benchmarks')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds per fake pdflatex pass')
+    parser.add_argument('--only', nargs='*', default=None,
+                        help='names of the benchmarks to run')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON results to this file')
+    parser.add_argument('--compare', default=None,
+                        help='an earlier JSON result file to compare with')
+    args = parser.parse_args(argv)
+
+    os.environ['FAKE_PDFLATEX_LATENCY'] = '%s' % args.latency
+    LaTeX_Document.latex_command = u'%s %s -interaction=nonstopmode' % (
+        shlex.quote(sys.executable), shlex.quote(FAKE_PDFLATEX))
+    LaTeX_Document.compile_socket = None
+
+    results = {}
+    for func in BENCHMARKS:
+        name = func.__name__
+        if args.only and name not in args.only:
+            continue
+        try:
+            results[name] = run(func, args.repeat)
+        except Skip as e:
+            results[name] = {'skipped': '%s' % e}
+        print('%-28s %s' % (name, results[name]), file=sys.stderr)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': args.latency,
+        'benchmarks': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
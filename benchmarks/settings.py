@@ -0,0 +1,22 @@
+"""
+Minimal Django settings for the LaTeXResponseMixin benchmarks.
+"""
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SECRET_KEY = 'benchmarks'
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+INSTALLED_APPS = [
+    'django.contrib.staticfiles',
+    'latex',
+]
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'DIRS': [os.path.join(BASE_DIR, 'templates')],
+    'OPTIONS': {'autoescape': False},
+}]
+STATIC_URL = '/static/'
+ROOT_URLCONF = None
+USE_TZ = True
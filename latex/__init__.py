@@ -1 +1 @@
-from .latex_document import LaTeX_Document
+from .latex_document import DocumentTemplate, LaTeX_Document
@@ -0,0 +1,155 @@
+"""
+A content-addressed store for the extra assets of compiles (logos,
+fonts, style files, ...).
+
+Each asset is fingerprinted (a hash of its contents) once per version:
+the fingerprint is remembered for the modification time and size of
+the file.  The store holds a hard link to each version (or, across file
+systems, a copy, made once) as ``<fingerprint>/<basename>``, and those
+directories are given to TeX in ``TEXINPUTS`` (and the other kpathsea
+search paths, fonts included), so compiles find their assets without
+any per-compile copies.
+
+Caveat: a hard link shares the contents of the original, so an asset
+that is edited in place (rather than replaced by a new file, as
+collectstatic does) would change under the store; use ``link=False``
+for such files.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+#######################
+
+DEFAULT_ASSET_DIR = os.path.join(tempfile.gettempdir(), 'python-latex-assets')
+# the kpathsea search paths that the store directories are added to:
+# sources, bibliographies and fonts (metrics, outlines, encodings, maps).
+SEARCH_PATHS = (
+    'TEXINPUTS', 'BIBINPUTS', 'BSTINPUTS',
+    'TFMFONTS', 'VFFONTS', 'T1FONTS', 'TTFONTS', 'OPENTYPEFONTS',
+    'ENCFONTS', 'TEXFONTMAPS',
+)
+
+#######################
+
+
+class AssetStore(object):
+    """
+    AssetStore(directory=None, link=True)
+
+    Several processes may safely share the same directory.
+
+    Useful methods:
+        * fingerprint(filename)     -- hex digest of the contents
+        * add(filename)     -- returns the store directory holding it
+        * environ(filenames, env=None)  -- environment for the engine process
+        * update_hash(h, filenames)     -- for cache keys and ETags
+        * stats()
+    """
+    def __init__(self, directory=None, link=True):
+        if directory is None:
+            directory = DEFAULT_ASSET_DIR
+        self.directory = directory
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._fingerprints = {}     # filename: (mtime, size, fingerprint)
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def fingerprint(self, filename):
+        """
+        Return the hex digest of the contents of ``filename``; the file
+        is only read again once its modification time or size change.
+        """
+        st = os.stat(filename)
+        version = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            known = self._fingerprints.get(filename)
+            if known is not None and known[:2] == version:
+                self.hits += 1
+                return known[2]
+            self.misses += 1
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                h.update(block)
+        fingerprint = h.hexdigest()
+        with self._lock:
+            self._fingerprints[filename] = version + (fingerprint, )
+        return fingerprint
+
+    def add(self, filename):
+        """
+        Put (this version of) ``filename`` in the store, if it is not
+        there yet, and return the directory holding it.
+        """
+        directory = os.path.join(self.directory, self.fingerprint(filename))
+        target = os.path.join(directory, os.path.basename(filename))
+        if os.path.exists(target):
+            return directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:     # made by another process
+                pass
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            os.remove(tmp_name)
+            try:
+                if not self.link:
+                    raise OSError('not linking')
+                os.link(filename, tmp_name)
+            except OSError:     # e.g., on another file system
+                shutil.copyfile(filename, tmp_name)
+            os.rename(tmp_name, target)
+        except Exception:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        return directory
+
+    def environ(self, filenames, env=None):
+        """
+        Return a copy of ``env`` (by default, the process environment)
+        in which the engine finds the ``filenames``, from the store.
+        """
+        directories = []
+        for filename in filenames:
+            directory = self.add(filename)
+            if directory not in directories:
+                directories.append(directory)
+        env = dict(os.environ if env is None else env)
+        if directories:
+            path = os.pathsep.join(directories)
+            for name in SEARCH_PATHS:
+                # the trailing separator keeps the default search path.
+                env[name] = path + os.pathsep + env.get(name, '')
+        return env
+
+    def update_hash(self, h, filenames):
+        """
+        Add the ``filenames`` to the hash ``h``, by their fingerprints;
+        see ``latex.cache.update_assets()``.
+        """
+        for filename in filenames:
+            h.update(b'\0')
+            h.update(os.path.basename(filename).encode('utf-8'))
+            h.update(b'\0')
+            h.update(self.fingerprint(filename).encode('ascii'))
+        return h
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'fingerprints': len(self._fingerprints),
+            }
@@ -0,0 +1,199 @@
+"""
+Persistent build state, for incremental rebuilds.
+
+A document that is compiled over and over while it is edited (say, a
+long report being previewed) normally starts from scratch every time,
+and needs a full set of reruns to resolve its cross-references.  Given
+a stable ``build_id``, LaTeX_Document keeps the auxiliary files (.aux,
+.toc, .bbl, ...) of its last successful compile in a BuildStore and
+restores them before the next one, which then starts from converged
+state and usually finishes in one pass.
+
+The store is bounded in size; the least recently used builds are
+evicted first.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import contextlib
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:     # not on Windows
+    fcntl = None
+
+#######################
+
+DEFAULT_BUILD_DIR = os.path.join(tempfile.gettempdir(), 'python-latex-builds')
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024     # bytes
+
+#######################
+
+
+class BuildStore(object):
+    """
+    BuildStore(directory=None, max_size=DEFAULT_MAX_SIZE)
+
+    Each build is a directory ``<key>`` in ``directory``, holding one
+    file for each of ``extensions``; its modification time is the
+    recency for LRU eviction.  A build is locked while its files are
+    copied in or out, so several threads and processes may safely
+    share the same directory.
+
+    Useful methods:
+        * key(build_id, command)
+        * restore(key, basename)    -- returns the number of files restored
+        * save(key, basename)
+        * discard(key)
+        * stats()       -- returns a dict of restores, saves, builds, size
+        * clear()
+    """
+    extensions = ('.aux', '.toc', '.out', '.bbl', '.lof', '.lot')
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = DEFAULT_BUILD_DIR
+        self.directory = directory
+        self.max_size = max_size
+        self.restores = 0
+        self.saves = 0
+        self._lock = threading.Lock()
+        self._locks = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, build_id, command=''):
+        h = hashlib.sha256()
+        h.update(command.encode('utf-8'))
+        h.update(b'\0')
+        h.update(('%s' % build_id).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    @contextlib.contextmanager
+    def _locked(self, key):
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._path(key) + '.lock', 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def restore(self, key, basename):
+        """
+        Copy the kept files of build ``key`` to ``basename`` plus their
+        extension.  Returns the number of files restored.
+        """
+        path = self._path(key)
+        restored = 0
+        with self._locked(key):
+            for extension in self.extensions:
+                try:
+                    shutil.copyfile(os.path.join(path, extension[1:]),
+                                    basename + extension)
+                except (IOError, OSError):
+                    continue
+                restored += 1
+            if restored:
+                os.utime(path, None)
+        if restored:
+            with self._lock:
+                self.restores += 1
+        return restored
+
+    def save(self, key, basename):
+        """
+        Keep the files ``basename`` plus each of ``extensions`` (those
+        that exist) as the state of build ``key``.
+        """
+        path = self._path(key)
+        with self._locked(key):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for extension in self.extensions:
+                target = os.path.join(path, extension[1:])
+                if not os.path.exists(basename + extension):
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+                fd, tmp_name = tempfile.mkstemp(suffix='.tmp', dir=path)
+                os.close(fd)
+                shutil.copyfile(basename + extension, tmp_name)
+                os.rename(tmp_name, target)
+            os.utime(path, None)
+        with self._lock:
+            self.saves += 1
+        self.evict()
+
+    def discard(self, key):
+        with self._locked(key):
+            shutil.rmtree(self._path(key), ignore_errors=True)
+
+    def _forget(self, key):
+        with self._lock:
+            self._locks.pop(key, None)
+        try:
+            os.remove(self._path(key) + '.lock')
+        except OSError:
+            pass
+
+    def _entries(self):
+        """
+        Return a list of (mtime, size, key) for every build.
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            if not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, filename))
+                           for filename in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, key))
+            except OSError:     # evicted by another process
+                continue
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used builds until the store fits
+        in ``max_size`` bytes.
+        """
+        entries = self._entries()
+        total = sum(size for mtime, size, key in entries)
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for mtime, size, key in entries:
+            if total <= self.max_size:
+                break
+            self.discard(key)
+            self._forget(key)
+            total -= size
+
+    def clear(self):
+        for mtime, size, key in self._entries():
+            self.discard(key)
+            self._forget(key)
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            'restores': self.restores,
+            'saves': self.saves,
+            'builds': len(entries),
+            'size': sum(size for mtime, size, key in entries),
+        }
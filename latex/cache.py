@@ -0,0 +1,196 @@
+"""
+A content-addressed, on-disk cache of compiled PDF files.
+
+Entries are keyed by a hash of the final LaTeX source, the contents of
+any extra assets and the engine command line, so identical documents
+are only ever compiled once.  The cache is bounded in size; the least
+recently used entries are evicted first.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+#######################
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'python-latex-cache')
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024    # bytes
+
+#######################
+
+
+def source_hasher(command=''):
+    """
+    Return a hash object for a compile job with the given ``command``;
+    feed it the UTF-8 encoded source, then call ``update_assets()``.
+    This allows a source to be hashed while it is being streamed.
+    """
+    h = hashlib.sha256()
+    h.update(command.encode('utf-8'))
+    h.update(b'\0')
+    return h
+
+
+def update_assets(h, extra_assets=()):
+    """
+    Add the contents of the files in ``extra_assets`` to the hash ``h``.
+    """
+    for filename in extra_assets:
+        h.update(b'\0')
+        h.update(os.path.basename(filename).encode('utf-8'))
+        h.update(b'\0')
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                h.update(block)
+    return h
+
+
+def source_digest(source, extra_assets=(), command=''):
+    """
+    Return a hex digest identifying a compile job: the ``source`` text,
+    the contents of each file in ``extra_assets`` and the ``command``.
+    """
+    h = source_hasher(command)
+    h.update(source.encode('utf-8', 'replace'))
+    return update_assets(h, extra_assets).hexdigest()
+
+
+def _link(filename, target):
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(filename, target)
+    except OSError:     # e.g., on another file system
+        shutil.copyfile(filename, target)
+
+
+class PDFCache(object):
+    """
+    PDFCache(directory=None, max_size=DEFAULT_MAX_SIZE)
+
+    Each entry is a pair of files ``<key>.pdf`` and ``<key>.log`` in
+    ``directory``.  The modification time of the PDF is bumped on
+    every hit, and is used as the recency for LRU eviction.  Several
+    processes may safely share the same directory.
+
+    Useful methods:
+        * key(source, extra_assets, command)
+        * get(key, target)  -- returns (pdf_filename, log) or None
+        * put(key, pdf_filename, log)
+        * stats()       -- returns a dict of hits, misses, entries, size
+        * clear()
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = DEFAULT_CACHE_DIR
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, source, extra_assets=(), command=''):
+        return source_digest(source, extra_assets, command)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def get(self, key, target=None):
+        """
+        Return ``(pdf_filename, log)`` for ``key``, or ``None`` on a miss.
+        With a ``target`` filename, the PDF is hard linked (or copied)
+        there, and ``target`` is returned: unlike the cached file, it
+        cannot be evicted (by any process) before it is read.
+        """
+        pdf_filename = self._path(key, '.pdf')
+        try:
+            with open(self._path(key, '.log'), 'rb') as f:
+                log = f.read().decode('utf-8', 'replace')
+            if target is not None:
+                _link(pdf_filename, target)
+                pdf_filename = target
+            os.utime(self._path(key, '.pdf'), None)
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return pdf_filename, log
+
+    def put(self, key, pdf_filename, log):
+        """
+        Store a copy of ``pdf_filename`` and its ``log`` under ``key``,
+        and return the filename of the cached PDF.
+        """
+        target = self._path(key, '.pdf')
+        fd, tmp_pdf = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        shutil.copyfile(pdf_filename, tmp_pdf)
+        fd, tmp_log = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write((log or '').encode('utf-8', 'replace'))
+        # the pdf goes in first: an entry is only visible once its log exists.
+        os.rename(tmp_pdf, target)
+        os.rename(tmp_log, self._path(key, '.log'))
+        self.evict()
+        return target
+
+    def _entries(self):
+        """
+        Return a list of (mtime, size, key) for every complete entry.
+        """
+        entries = []
+        for filename in os.listdir(self.directory):
+            key, extension = os.path.splitext(filename)
+            if extension != '.pdf':
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, filename))
+                size = st.st_size + os.path.getsize(self._path(key, '.log'))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, size, key))
+        return entries
+
+    def _remove(self, key):
+        for extension in ('.log', '.pdf'):
+            try:
+                os.remove(self._path(key, extension))
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits
+        in ``max_size`` bytes.
+        """
+        entries = self._entries()
+        total = sum(size for mtime, size, key in entries)
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for mtime, size, key in entries:
+            if total <= self.max_size:
+                break
+            self._remove(key)
+            total -= size
+
+    def clear(self):
+        for mtime, size, key in self._entries():
+            self._remove(key)
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'size': sum(size for mtime, size, key in entries),
+        }
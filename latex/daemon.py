@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+A local compile service.
+
+Run one daemon per host to bound TeX concurrency independently of the
+number of web workers:
+
+    python -m latex.daemon --socket /run/latex.sock --workers 4 --max-queue 32
+
+and point LaTeX_Document at it, either with the ``LATEX_COMPILE_SOCKET``
+environment variable or by setting ``LaTeX_Document.compile_socket``.
+
+Jobs beyond ``workers`` wait in a queue of at most ``max_queue``
+entries; further jobs are rejected straight away, and the client
+raises ``CompileServiceBusy``.
+
+A job may carry a ``timeout``: the service stops it that many seconds
+after it arrives, queueing included.  A client that gets no answer
+shortly after its timeout raises ``CompileServiceTimeout``.
+
+Wire format: every message is a 4-byte big-endian length followed by
+that many bytes.  The client sends one JSON job; the server answers
+with a JSON header and, if the header has ``"pdf": true``, a second
+message with the PDF data.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+#######################
+
+
+class CompileServiceBusy(RuntimeError):
+    """
+    The compile service queue is full.
+    """
+
+
+class CompileServiceError(RuntimeError):
+    """
+    The compile service failed to run a job.
+    """
+
+
+class CompileServiceTimeout(CompileServiceError):
+    """
+    The compile service did not answer in time.
+    """
+
+
+# seconds to wait for an answer after the timeout of a job
+REPLY_GRACE = 5
+
+
+def _frame(data):
+    return struct.pack('>I', len(data)) + data
+
+
+def _recv_exactly(sock, length):
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, 1024 * 1024))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_frame(sock):
+    length = struct.unpack('>I', _recv_exactly(sock, 4))[0]
+    return _recv_exactly(sock, length)
+
+
+async def _read_frame_async(reader):
+    length = struct.unpack('>I', await reader.readexactly(4))[0]
+    return await reader.readexactly(length)
+
+
+def _job(source, extra_assets, timeout):
+    job = {
+        'source': source,
+        'extra_assets': [os.path.abspath(fn) for fn in extra_assets],
+        'timeout': timeout,
+    }
+    return json.dumps(job).encode('utf-8')
+
+
+def _check(header):
+    if header['status'] == 'busy':
+        raise CompileServiceBusy(header.get('error', 'queue full'))
+    if header['status'] != 'ok':
+        raise CompileServiceError(header.get('error', 'unknown error'))
+    return header
+
+
+def submit(socket_path, source, extra_assets=(), timeout=None):
+    """
+    Compile ``source`` on the service listening on ``socket_path``,
+    within ``timeout`` seconds if given.
+    Returns (header, pdf_data); pdf_data is None if there is no output.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if timeout is not None:
+        sock.settimeout(timeout + REPLY_GRACE)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(_frame(_job(source, extra_assets, timeout)))
+        header = _check(json.loads(_recv_frame(sock).decode('utf-8')))
+        pdf_data = _recv_frame(sock) if header['pdf'] else None
+    except socket.timeout:
+        raise CompileServiceTimeout('no answer in %s seconds' % timeout)
+    finally:
+        sock.close()
+    return header, pdf_data
+
+
+async def _submit_async(socket_path, source, extra_assets, timeout):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(_frame(_job(source, extra_assets, timeout)))
+        await writer.drain()
+        header = await _read_frame_async(reader)
+        header = _check(json.loads(header.decode('utf-8')))
+        pdf_data = await _read_frame_async(reader) if header['pdf'] else None
+    finally:
+        writer.close()
+    return header, pdf_data
+
+
+async def submit_async(socket_path, source, extra_assets=(), timeout=None):
+    """
+    As ``submit()``, for use from an event loop.
+    """
+    if timeout is None:
+        return await _submit_async(socket_path, source, extra_assets, None)
+    try:
+        return await asyncio.wait_for(
+            _submit_async(socket_path, source, extra_assets, timeout),
+            timeout + REPLY_GRACE)
+    except asyncio.TimeoutError:
+        raise CompileServiceTimeout('no answer in %s seconds' % timeout)
+
+
+def stats(socket_path):
+    """
+    Return the counters of the service listening on ``socket_path``.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(_frame(json.dumps({'command': 'stats'}).encode('utf-8')))
+        return json.loads(_recv_frame(sock).decode('utf-8'))
+    finally:
+        sock.close()
+
+
+#######################
+
+
+class CompileRequestHandler(socketserver.BaseRequestHandler):
+
+    def send_json(self, data):
+        self.request.sendall(_frame(json.dumps(data).encode('utf-8')))
+
+    def handle(self):
+        try:
+            job = json.loads(_recv_frame(self.request).decode('utf-8'))
+        except (EOFError, ValueError):
+            return
+        if job.get('command') == 'stats':
+            self.send_json(self.server.stats())
+            return
+        if not self.server.enqueue():
+            self.send_json({'status': 'busy', 'error': 'queue full'})
+            return
+        try:
+            doc, result = self.server.compile(job)
+        except Exception as e:
+            self.send_json({'status': 'error', 'error': '%s' % e})
+            return
+        pdf_data = doc.pdf_data()
+        self.send_json({
+            'status': 'ok',
+            'result': bool(result),
+            'aborted': result.aborted,
+            'log': doc.log,
+            'passes': result.passes,
+            'pass_times': result.pass_times,
+            'pdf': pdf_data is not None,
+        })
+        if pdf_data is not None:
+            self.request.sendall(_frame(pdf_data))
+
+
+class CompileServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """
+    CompileServer(socket_path, workers=None, max_queue=None)
+
+    Each connection gets a thread, but at most ``workers`` jobs
+    compile at once; at most ``max_queue`` more wait their turn.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=None, max_queue=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if max_queue is None:
+            max_queue = 8 * workers
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers)
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               CompileRequestHandler)
+
+    def enqueue(self):
+        """
+        Reserve a queue slot for a new job; returns False if full.
+        """
+        with self._lock:
+            if self.queued + self.running >= self.workers + self.max_queue:
+                self.rejected += 1
+                return False
+            self.queued += 1
+        return True
+
+    def compile(self, job):
+        from .latex_document import LaTeX_Document
+        received = time.time()
+        with self._slots:
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                doc = LaTeX_Document()
+                doc.compile_socket = None   # always compile locally
+                doc.source = job['source']
+                if job.get('timeout') is not None:
+                    timeout = job['timeout'] - (time.time() - received)
+                    if doc.timeout is None or timeout < doc.timeout:
+                        doc.timeout = max(timeout, 0)
+                result = doc.compile(extra_assets=job.get('extra_assets', []))
+                return doc, result
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'status': 'ok',
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'running': self.running,
+                'queued': self.queued,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LaTeX compile service')
+    parser.add_argument('--socket', required=True,
+                        help='path of the unix socket to listen on')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of concurrent compiles (default: CPUs)')
+    parser.add_argument('--max-queue', type=int, default=None,
+                        help='number of waiting jobs before rejecting')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds allowed for each compile')
+    args = parser.parse_args(argv)
+    if args.timeout is not None:
+        from .latex_document import LaTeX_Document
+        LaTeX_Document.timeout = args.timeout
+    server = CompileServer(args.socket, args.workers, args.max_queue)
+    print('Listening on %s (%d workers, queue %d)' % (
+        args.socket, server.workers, server.max_queue), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,194 @@
 """
 Useful with Django>=1.3
 """
+import asyncio
 import os
+import threading
+import time
+import uuid
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 import django
 from django.conf import settings
 from django.contrib.staticfiles.finders import find as staticfiles_finder
-from django.http import HttpResponse, HttpResponseServerError
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.template.base import TextNode
+from django.template.context import make_context
+from django.template.defaulttags import ForNode
+from django.template.loader_tags import (BLOCK_CONTEXT_KEY, BlockContext,
+                                         BlockNode, ExtendsNode)
 from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 
-from .latex_document import LaTeX_Document
-from .utils import latex_fixes
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:     # Django < 3.0
+    sync_to_async = None
+
+from . import hooks
+from .cache import source_digest
+from .daemon import CompileServiceBusy
+from .latex_document import (LaTeX_Document, compile_many, merge_source,
+                             without_page_numbers)
+from .utils import escape_all, iter_latex_fixes, latex_fixes
+
+
+# staticfiles_finder() results, by name; static files do not move
+# while the process runs.
+_static_filenames = {}
+
+# characters of rendered template per chunk, see iter_render_template().
+RENDER_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_nodes(nodelist, context):
+    for node in nodelist:
+        # exact types: a subclass may render differently.
+        if type(node) is ForNode:
+            chunks = _iter_for(node, context)
+        elif type(node) is BlockNode:
+            chunks = _iter_block(node, context)
+        elif type(node) is ExtendsNode:
+            chunks = _iter_extends(node, context)
+        else:
+            chunks = (node.render_annotated(context), )
+        for chunk in chunks:
+            yield chunk
+
+
+def _iter_for(node, context):
+    # as ForNode.render(), one iteration at a time.
+    parentloop = context['forloop'] if 'forloop' in context else {}
+    with context.push():
+        values = node.sequence.resolve(context, ignore_failures=True)
+        if values is None:
+            values = []
+        if not hasattr(values, '__len__'):
+            values = list(values)
+        len_values = len(values)
+        if len_values < 1:
+            yield node.nodelist_empty.render(context)
+            return
+        if node.is_reversed:
+            values = reversed(values)
+        num_loopvars = len(node.loopvars)
+        loop_dict = context['forloop'] = {'parentloop': parentloop}
+        for i, item in enumerate(values):
+            loop_dict['counter0'] = i
+            loop_dict['counter'] = i + 1
+            loop_dict['revcounter'] = len_values - i
+            loop_dict['revcounter0'] = len_values - i - 1
+            loop_dict['first'] = (i == 0)
+            loop_dict['last'] = (i == len_values - 1)
+            if num_loopvars > 1:
+                try:
+                    len_item = len(item)
+                except TypeError:   # not an iterable
+                    len_item = 1
+                if num_loopvars != len_item:
+                    raise ValueError(
+                        'Need {0} values to unpack in for loop; got {1}. '
+                        .format(num_loopvars, len_item))
+                context.update(dict(zip(node.loopvars, item)))
+            else:
+                context[node.loopvars[0]] = item
+            for chunk in _iter_nodes(node.nodelist_loop, context):
+                yield chunk
+            if num_loopvars > 1:
+                context.pop()
+
+
+def _iter_block(node, context):
+    # as BlockNode.render().
+    block_context = context.render_context.get(BLOCK_CONTEXT_KEY)
+    with context.push():
+        if block_context is None:
+            context['block'] = node
+            for chunk in _iter_nodes(node.nodelist, context):
+                yield chunk
+            return
+        push = block = block_context.pop(node.name)
+        if block is None:
+            block = node
+        block = type(node)(block.name, block.nodelist)
+        block.context = context
+        context['block'] = block
+        for chunk in _iter_nodes(block.nodelist, context):
+            yield chunk
+        if push is not None:
+            block_context.push(node.name, push)
+
+
+def _iter_extends(node, context):
+    # as ExtendsNode.render().
+    compiled_parent = node.get_parent(context)
+    if BLOCK_CONTEXT_KEY not in context.render_context:
+        context.render_context[BLOCK_CONTEXT_KEY] = BlockContext()
+    block_context = context.render_context[BLOCK_CONTEXT_KEY]
+    block_context.add_blocks(node.blocks)
+    for parent_node in compiled_parent.nodelist:
+        if not isinstance(parent_node, TextNode):
+            if not isinstance(parent_node, ExtendsNode):
+                block_context.add_blocks(dict(
+                    (n.name, n) for n in
+                    compiled_parent.nodelist.get_nodes_by_type(BlockNode)))
+            break
+    with context.render_context.push_state(compiled_parent,
+                                           isolated_context=False):
+        for chunk in _iter_nodes(compiled_parent.nodelist, context):
+            yield chunk
+
+
+def _coalesce(chunks, size=RENDER_CHUNK_SIZE):
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield u''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield u''.join(buffer)
+
+
+def iter_render_template(template, context, request=None):
+    """
+    Render a (Django backend) template in chunks (of about
+    ``RENDER_CHUNK_SIZE`` characters), yielding each as it is done:
+    {% for %} loops are rendered one iteration at a time, and
+    {% extends %} and {% block %} are followed, so that a long list is
+    never held in memory as a whole.  Other tags ({% if %},
+    {% include %}, ...) are rendered whole, and other template backends
+    in one piece.
+    """
+    base = getattr(template, 'template', None)
+    if getattr(base, 'nodelist', None) is None:
+        yield template.render(context, request)
+        return
+    context = make_context(context, request,
+                           autoescape=template.backend.engine.autoescape)
+    with context.render_context.push_state(base):
+        with context.bind_template(base):
+            context.template_name = base.name
+            for chunk in _coalesce(_iter_nodes(base.nodelist, context)):
+                yield chunk
 
 
 class LaTeXResponseMixin(object):
     """
     For delivering the response -- compiling to PDF etc.
-    NOTE: there is currently *no way* to deal with compilation errors.
+
+    A compile that runs over ``compile_timeout`` (or the limits set on
+    LaTeX_Document) gets a quick 504 (or 500), and a full compile
+    service a 503, so a bad document cannot tie up the workers.
     """
     as_attachment = True    # send filename and content-disposition headers
     extra_assets = None     # provide a list, if there are any.
@@ -26,6 +196,13 @@ class LaTeXResponseMixin(object):
     allow_source_from_get = True
     allow_source_from_post = True
     filename = None         
+    pdf_cache = None        # a latex.cache.PDFCache, to reuse identical PDFs
+    format_cache = None     # a latex.formats.FormatCache, for shared preambles
+    asset_store = None      # a latex.assets.AssetStore, to link extra assets
+    build_store = None      # a latex.builds.BuildStore, see get_build_id()
+    escape_context = False  # escape the strings in the context, all at once
+    fixups = None           # a latex.utils.FixupPipeline; default_fixups if None
+    compile_timeout = None  # seconds; by default, LaTeX_Document.timeout
     
     
     def get_as_attachment(self):
@@ -100,9 +277,15 @@ class LaTeXResponseMixin(object):
         """
         This hook resolves static assets provided as extra assets
         to absolute filenames.  This will probably break for any
-        kind of non-local storage.
+        kind of non-local storage.  Names are only looked up once
+        per process.
         """
-        return staticfiles_finder(filename)
+        found = _static_filenames.get(filename)
+        if found is None:
+            found = staticfiles_finder(filename)
+            if found is not None:
+                _static_filenames[filename] = found
+        return found
         
         
     def get_extra_assets(self):
@@ -120,50 +303,653 @@ class LaTeXResponseMixin(object):
                     for asset in self.extra_assets ]
 
 
+    def get_escaped_context(self, context):
+        """
+        Returns ``context`` with every string in it (including those in
+        lists and dicts) escaped for LaTeX, and marked safe.  Other
+        objects, such as model instances, are left alone: use the
+        latex_escape filter (from latex_tags) for their fields.
+        """
+        escaped = {}
+        for key, value in context.items():
+            if isinstance(value, (str, list, tuple, dict)):
+                value = escape_all(value, wrap=mark_safe)
+            escaped[key] = value
+        return escaped
+
+
+    def get_template_response(self, context, **response_kwargs):
+        if self.escape_context:
+            context = self.get_escaped_context(context)
+        return TemplateResponse(request=self.request,
+                                template=self.get_template_names(),
+                                context=context,
+                                content_type='application/x-latex',
+                                **response_kwargs)
+
+
+    def get_latex_document(self, source=None):
+        doc = LaTeX_Document()
+        if self.pdf_cache is not None:
+            doc.cache = self.pdf_cache
+        if self.format_cache is not None:
+            doc.format_cache = self.format_cache
+        if self.asset_store is not None:
+            doc.asset_store = self.asset_store
+        if self.build_store is not None:
+            doc.build_store = self.build_store
+            doc.build_id = self.get_build_id()
+        if self.compile_timeout is not None:
+            doc.timeout = self.compile_timeout
+        scratch_dir = getattr(settings, 'LATEX_SCRATCH_DIR', None)
+        if scratch_dir:
+            doc.scratch_dir = scratch_dir
+        compile_socket = getattr(settings, 'LATEX_COMPILE_SOCKET', None)
+        if compile_socket:
+            doc.compile_socket = compile_socket
+        if source is not None:
+            doc.source = source
+        return doc
+
+
+    def get_build_id(self):
+        """
+        Return a stable id for the document being rendered, to keep its
+        auxiliary files between compiles (with ``build_store``), or None.
+        """
+        return None
+
+
+    def iter_rendered_content(self, response):
+        """
+        The content of the template ``response``, rendered in chunks.
+        """
+        template = response.resolve_template(response.template_name)
+        context = response.resolve_context(response.context_data)
+        return iter_render_template(template, context, self.request)
+
+
+    def write_document_source(self, doc, response):
+        """
+        Set the source of ``doc`` to the template ``response``, fixed up
+        with latex_fixes(): streamed straight into its source file, or,
+        with a ``format_cache`` (which does not work on streamed
+        sources), built in memory.
+        """
+        chunks = iter_latex_fixes(self.iter_rendered_content(response),
+                                  self.fixups)
+        if doc.format_cache is not None:
+            doc.set_full_src(u''.join(chunks))
+        else:
+            doc.write_source(chunks)
+
+
+    def get_pdf_response(self, doc, cleanup=True):
+        """
+        Build the response for a compiled document.  The PDF is streamed
+        from disk (with sendfile, where the server supports it).
+        """
+        output = doc.open_output(cleanup=cleanup)
+        if output is None:
+            aborted = doc.result.aborted if doc.result is not None else None
+            if aborted == 'timeout':
+                return self.get_error_response(504, 'PDF generation timed out',
+                                               doc)
+            if aborted == 'limit':
+                return self.get_error_response(
+                    500, 'PDF generation exceeded its resource limits', doc)
+            return self.get_error_response(500, 'Failed to generate PDF', doc)
+        # with cleanup, the temporary files are removed once the response
+        # is closed, i.e., after the PDF has been streamed out.
+        return FileResponse(output, content_type='application/pdf')
+
+
+    def get_error_response(self, status, message, doc=None):
+        """
+        A short error page; with DEBUG, the log of ``doc`` is included.
+        """
+        response = HttpResponse(status=status)
+        content = "<html><head></head><body></body><h1>%d %s</h1><h2>%s</h2>\n\n%s</body></html>"
+        debug = getattr(settings, 'DEBUG', False)
+        if debug and doc is not None:
+            log = '<pre>%s</pre>' % doc.log
+        else:
+            log = ''
+        response.content = content % (status, response.reason_phrase,
+                                      message, log)
+        return response
+
+
+    def get_busy_response(self):
+        """
+        The response when the compile service has no room for the job.
+        """
+        response = self.get_error_response(503, 'PDF service busy')
+        response['Retry-After'] = '1'
+        return response
+
+
+    def get_last_modified(self):
+        """
+        Return a datetime (or a date) for the last change to the data
+        behind the document, or None if unknown.  When provided,
+        requests with a current If-Modified-Since are answered before
+        rendering.
+        """
+        return None
+
+
+    def _get_last_modified_timestamp(self):
+        last_modified = self.get_last_modified()
+        if last_modified is None:
+            return None
+        if not isinstance(last_modified, datetime):
+            # a date, e.g., of a DateField: its start, in UTC.
+            return timegm(last_modified.timetuple())
+        return timegm(last_modified.utctimetuple())
+
+
+    def get_not_modified_response(self, etag=None, last_modified=None):
+        """
+        Returns a 304 (or 412) response if the client's copy is current,
+        otherwise None.  Without an ``etag`` (i.e., before rendering) only
+        a plain If-Modified-Since request can be answered.
+        """
+        if etag is None:
+            if last_modified is None or \
+                    'HTTP_IF_NONE_MATCH' in self.request.META or \
+                    'HTTP_IF_MATCH' in self.request.META:
+                return None
+        response = get_conditional_response(self.request, etag=etag,
+                                            last_modified=last_modified)
+        if response is not None and response.status_code == 304:
+            self._set_validators(response, etag, last_modified)
+        return response
+
+
+    def _set_validators(self, response, etag, last_modified):
+        if etag is not None:
+            response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+
+
+    def _render_source(self, response, extra_assets):
+        """
+        Render the template; returns the document to compile (None in
+        source mode) and a strong ETag: a hash of the LaTeX source and
+        the assets (and whether the source or the PDF is being sent).
+
+        For PDFs, the template output goes through latex_fixes() into
+        the document, see write_document_source().  In source mode
+        the response content is set directly, so the template is not
+        rendered twice.
+        """
+        if self.get_as_source():
+            source = response.rendered_content
+            response.content = source
+            return None, quote_etag(source_digest(source, [], 'source'))
+        doc = self.get_latex_document()
+        self.write_document_source(doc, response)
+        return doc, quote_etag(doc.source_digest(extra_assets))
+
+
+    def dispatch(self, request, *args, **kwargs):
+        """
+        Sends the ``latex.hooks`` response hooks around the request.
+        The time reported is until the response is returned, i.e.,
+        before a streamed PDF is sent.
+        """
+        started = time.time()
+        hooks.response_started.send(self.__class__, view=self,
+                                    request=request)
+        try:
+            response = super(LaTeXResponseMixin, self).dispatch(
+                request, *args, **kwargs)
+        except CompileServiceBusy:
+            response = self.get_busy_response()
+        if asyncio.iscoroutine(response):
+            return self._afinish_response(request, response, started)
+        return self._finish_response(request, response, started)
+
+
+    def _finish_response(self, request, response, started):
+        hooks.response_finished.send(self.__class__, view=self,
+                                     request=request, response=response,
+                                     seconds=time.time() - started)
+        return response
+
+
+    async def _afinish_response(self, request, response, started):
+        try:
+            response = await response
+        except CompileServiceBusy:
+            response = self.get_busy_response()
+        return self._finish_response(request, response, started)
+
+
     def render_to_response(self, context, **response_kwargs):
-        response = TemplateResponse(request=self.request,
-                                    template=self.get_template_names(),
-                                    context=context,
-                                    content_type='application/x-latex',
-                                    **response_kwargs)
-
-        if not self.get_as_source():
-            doc = LaTeX_Document()
-            doc.source = latex_fixes(response.rendered_content)
-            extra_assets = self.get_extra_assets()
+        last_modified = self._get_last_modified_timestamp()
+        not_modified = self.get_not_modified_response(
+            last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = self.get_template_response(context, **response_kwargs)
+        as_source = self.get_as_source()
+        extra_assets = [] if as_source else self.get_extra_assets()
+        doc, etag = self._render_source(response, extra_assets)
+        not_modified = self.get_not_modified_response(etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        if not as_source:
             doc.compile(extra_assets=extra_assets)
-            data = doc.output
-            if doc.filename is None:
-                debug = getattr(settings, 'DEBUG', False)
-                content = "<html><head></head><body></body><h1>500 Server Error</h1><h2>Failed to generate PDF</h2>\n\n%s</body></html>"
-                if debug:
-                    content = content % ('<pre>%s</pre>' % doc.log)
-                else:
-                    content = content % ''
-                return HttpResponseServerError(content)
-            response = HttpResponse(data, content_type='application/pdf')
-        else:
-            doc = None
+            response = self.get_pdf_response(doc)
+            if response.status_code != 200:
+                return response
             
+        self._set_validators(response, etag, last_modified)
         filename = self.get_filename(doc)            
         self._augment_response(response, filename)
         return response
 
 
+    async def arender_to_response(self, context, **response_kwargs):
+        """
+        Async version of render_to_response(), for ASGI deployments.
+        The template is rendered in a worker thread (it may query the
+        database) and TeX runs as an asyncio subprocess.
+        """
+        last_modified = self._get_last_modified_timestamp()
+        not_modified = self.get_not_modified_response(
+            last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = self.get_template_response(context, **response_kwargs)
+        as_source = self.get_as_source()
+        extra_assets = [] if as_source else self.get_extra_assets()
+        doc, etag = await sync_to_async(self._render_source)(
+            response, extra_assets)
+        not_modified = self.get_not_modified_response(etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        if not as_source:
+            await doc.compile_async(extra_assets=extra_assets)
+            response = await sync_to_async(self.get_pdf_response)(doc)
+            if response.status_code != 200:
+                return response
+
+        self._set_validators(response, etag, last_modified)
+        filename = self.get_filename(doc)
+        self._augment_response(response, filename)
+        return response
+
+
 class LaTeXDetailView(LaTeXResponseMixin, DetailView):
     """
     For rendering a single object via LaTeX template to PDF and
     delivering the PDF.
     """
+    last_modified_field = None  # e.g., 'updated', for Last-Modified
+
+    def get_last_modified(self):
+        if self.last_modified_field is None:
+            return None
+        return getattr(self.object, self.last_modified_field)
+
+    def get_build_id(self):
+        """
+        The object and the template identify the document.
+        """
+        return '{0}.{1}:{2}'.format(self.object._meta.label, self.object.pk,
+                                    self.get_template_names()[0])
 
 LaTeX_DetailView = LaTeXDetailView
 
 
 
+class DeferredJob(object):
+    """
+    A background compile started by a deferred LaTeXListView.
+    """
+    def __init__(self, doc, future):
+        self.id = uuid.uuid4().hex
+        self.doc = doc
+        self.future = future
+        self.created = time.time()
+
+    @property
+    def status(self):
+        if not self.future.done():
+            return 'running' if self.future.running() else 'pending'
+        if self.future.exception() is None and self.future.result():
+            return 'done'
+        return 'failed'
+
+    def discard(self):
+        self.future.cancel()
+        if self.future.done():
+            self.doc.cleanup()
+
+
+_deferred_jobs = {}
+_deferred_lock = threading.Lock()
+_deferred_executor = None
+
+
+def _get_deferred_executor():
+    global _deferred_executor
+    with _deferred_lock:
+        if _deferred_executor is None:
+            _deferred_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'LATEX_DEFERRED_WORKERS', None))
+        return _deferred_executor
+
+
+
 class LaTeXListView(LaTeXResponseMixin, ListView):
     """
     For rendering a list of objects via LaTeX templates to PDF
     and delivering the PDF.
+
+    With ``deferred = True``, the first request renders the template,
+    starts the compile in the background and answers 202 with the job
+    URL (in the Location header and the JSON body); requests to the job
+    URL answer 202 with the progress until the PDF is ready, then
+    deliver it.  Jobs are kept in the memory of the process, for
+    ``deferred_job_ttl`` seconds, so this needs sticky routing
+    when there are several worker processes.
+
+    With ``chunk_size`` set, a long object list is rendered through the
+    template in chunks of that many objects; the chunks are compiled in
+    parallel, without page numbers, and merged into one PDF (with
+    pdfpages), whose pages are numbered in the plain style.  Page styles
+    of the template, references across chunks, and page totals such as
+    lastpage, are not supported in this mode.
     """
+    deferred = False
+    deferred_job_param = 'job'
+    deferred_job_ttl = 3600
+    chunk_size = None       # objects per chunk, to compile big lists in parallel
+    chunk_workers = None    # default: the number of CPUs
+
+    def get_deferred(self):
+        """Allow for conditional overrides, if required"""
+        return self.deferred
+
+
+    def get_chunk_size(self):
+        """Allow for conditional overrides, if required"""
+        return self.chunk_size
+
+
+    def use_chunks(self, context):
+        chunk_size = self.get_chunk_size()
+        return bool(chunk_size) and len(context['object_list']) > chunk_size
+
+
+    def render_chunks(self, context, **response_kwargs):
+        """
+        Render the template once per chunk of the object list;
+        returns the list of (fixed up) sources.
+        """
+        # the name (e.g., book_list) comes from the model of the queryset.
+        context_object_name = self.get_context_object_name(
+            context['object_list'])
+        objects = list(context['object_list'])
+        size = self.get_chunk_size()
+        sources = []
+        for start in range(0, len(objects), size):
+            chunk = objects[start:start + size]
+            chunk_context = dict(context)
+            chunk_context['object_list'] = chunk
+            if context_object_name is not None:
+                chunk_context[context_object_name] = chunk
+            response = self.get_template_response(chunk_context,
+                                                  **response_kwargs)
+            sources.append(latex_fixes(response.rendered_content,
+                                       self.fixups))
+        return sources
+
+
+    def get_chunk_documents(self, sources):
+        return [self.get_latex_document(without_page_numbers(source))
+                for source in sources]
+
+
+    def merge_chunks(self, docs, outcomes):
+        """
+        Returns the document merging the compiled chunk ``docs`` (not yet
+        compiled), or the first chunk that failed; ``outcomes`` are the
+        results of their compiles, or the exceptions they raised.
+        """
+        for outcome in outcomes:
+            if isinstance(outcome, CompileServiceBusy):
+                raise outcome
+        for doc, outcome in zip(docs, outcomes):
+            if isinstance(outcome, Exception) or not outcome:
+                return doc
+        filenames = [doc._out_file for doc in docs]
+        merged = self.get_latex_document(
+            merge_source(filenames, u'\\thispagestyle{plain}'))
+        merged.asset_store = None   # the chunks are one-off files
+        return merged
+
+
+    def compile_chunks(self, sources):
+        """
+        Compile the chunk ``sources`` in parallel, in one round, and
+        merge them.  Returns the merged document, or the first chunk
+        that failed.
+        """
+        extra_assets = self.get_extra_assets()
+        docs = self.get_chunk_documents(sources)
+        outcomes = [result.error or result.result for result in compile_many(
+            docs, max_workers=self.chunk_workers, extra_assets=extra_assets)]
+        merged = self.merge_chunks(docs, outcomes)
+        if merged in docs:
+            return merged
+        merged.compile(extra_assets=[doc._out_file for doc in docs])
+        for doc in docs:
+            doc.cleanup()
+        return merged
+
+
+    async def acompile_chunks(self, sources):
+        """
+        As compile_chunks(), with the TeX processes awaited on the event
+        loop rather than run from threads.
+        """
+        extra_assets = self.get_extra_assets()
+        docs = self.get_chunk_documents(sources)
+        slots = asyncio.Semaphore(self.chunk_workers or os.cpu_count() or 1)
+
+        async def compile_chunk(doc):
+            async with slots:
+                return await doc.compile_async(extra_assets=extra_assets)
+
+        outcomes = await asyncio.gather(
+            *[compile_chunk(doc) for doc in docs], return_exceptions=True)
+        merged = self.merge_chunks(docs, outcomes)
+        if merged in docs:
+            return merged
+        await merged.compile_async(extra_assets=[doc._out_file
+                                                 for doc in docs])
+        for doc in docs:
+            doc.cleanup()
+        return merged
+
+
+    def get_job_url(self, job):
+        query = self.request.GET.copy()
+        query[self.deferred_job_param] = job.id
+        return '{0}?{1}'.format(self.request.path, query.urlencode())
+
+
+    def get_job_response(self, job):
+        """
+        The response to a request for ``job``: progress while it is
+        running, the PDF when done, or an error if the compile raised.
+        """
+        status = job.status
+        if status in ('pending', 'running'):
+            response = JsonResponse({
+                'job': job.id,
+                'status': status,
+                'elapsed': time.time() - job.created,
+                'url': self.get_job_url(job),
+            }, status=202)
+            response['Location'] = self.get_job_url(job)
+            response['Retry-After'] = '1'
+            return response
+        # a document whose compile raised is not compiled; open_output()
+        # would compile it again, here.
+        error = job.future.exception()
+        if isinstance(error, CompileServiceBusy):
+            return self.get_busy_response()
+        if error is not None:
+            return self.get_error_response(500, 'Failed to generate PDF',
+                                           job.doc)
+        # the job keeps its files until it expires, for repeat downloads.
+        response = self.get_pdf_response(job.doc, cleanup=False)
+        if response.status_code != 200:
+            return response
+        self._augment_response(response, self.get_filename(job.doc))
+        return response
+
+
+    def expire_jobs(self):
+        cutoff = time.time() - self.deferred_job_ttl
+        with _deferred_lock:
+            expired = [job for job in _deferred_jobs.values()
+                       if job.created < cutoff]
+            for job in expired:
+                del _deferred_jobs[job.id]
+        for job in expired:
+            job.discard()
+
+
+    def start_job(self, context, **response_kwargs):
+        """
+        Render the template now, and compile it in the background.
+        """
+        self.expire_jobs()
+        response = self.get_template_response(context, **response_kwargs)
+        doc = self.get_latex_document()
+        self.write_document_source(doc, response)
+        future = _get_deferred_executor().submit(
+            doc.compile, extra_assets=self.get_extra_assets())
+        job = DeferredJob(doc, future)
+        with _deferred_lock:
+            _deferred_jobs[job.id] = job
+        return job
+
+
+    def get_requested_job(self):
+        """
+        Returns the job asked for by the request, or None if the request
+        is not for a job.
+        """
+        job_id = self.request.GET.get(self.deferred_job_param)
+        if not job_id or not self.get_deferred() or self.get_as_source():
+            return None
+        with _deferred_lock:
+            job = _deferred_jobs.get(job_id)
+        if job is None:
+            raise Http404('No such job (it may have expired).')
+        return job
+
+
+    def get(self, request, *args, **kwargs):
+        job = self.get_requested_job()
+        if job is not None:
+            return self.get_job_response(job)
+        return super(LaTeXListView, self).get(request, *args, **kwargs)
+
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.get_as_source():
+            return super(LaTeXListView, self).render_to_response(
+                context, **response_kwargs)
+        if self.get_deferred():
+            return self.get_job_response(self.start_job(context,
+                                                        **response_kwargs))
+        if self.use_chunks(context):
+            doc = self.compile_chunks(self.render_chunks(context,
+                                                         **response_kwargs))
+            response = self.get_pdf_response(doc)
+            if response.status_code == 200:
+                self._augment_response(response, self.get_filename(doc))
+            return response
+        return super(LaTeXListView, self).render_to_response(
+            context, **response_kwargs)
 
 LaTeX_ListView = LaTeXListView
+
+
+
+class AsyncLaTeXDetailView(LaTeXDetailView):
+    """
+    As LaTeXDetailView, but compiles without holding a thread.
+    Requires Django>=4.1 (async class-based views).
+    """
+    async def get(self, request, *args, **kwargs):
+        self.object = await sync_to_async(self.get_object)()
+        context = await sync_to_async(self.get_context_data)(
+            object=self.object)
+        return await self.arender_to_response(context)
+
+
+
+class AsyncLaTeXListView(LaTeXListView):
+    """
+    As LaTeXListView, but compiles without holding a thread, chunks
+    included; deferred jobs compile in the background as usual.
+    Requires Django>=4.1 (async class-based views).
+    """
+    def get_list_context(self):
+        """
+        The synchronous part of ListView.get(): everything except
+        rendering the response.
+        """
+        self.object_list = self.get_queryset()
+        allow_empty = self.get_allow_empty()
+        if not allow_empty:
+            if self.get_paginate_by(self.object_list) is not None and \
+                    hasattr(self.object_list, 'exists'):
+                is_empty = not self.object_list.exists()
+            else:
+                is_empty = not self.object_list
+            if is_empty:
+                raise Http404("Empty list and '%s.allow_empty' is False."
+                              % self.__class__.__name__)
+        return self.get_context_data()
+
+    async def get(self, request, *args, **kwargs):
+        job = self.get_requested_job()
+        if job is not None:
+            return await sync_to_async(self.get_job_response)(job)
+        context = await sync_to_async(self.get_list_context)()
+        return await self.arender_to_response(context)
+
+    async def arender_to_response(self, context, **response_kwargs):
+        if self.get_as_source():
+            return await super(AsyncLaTeXListView, self).arender_to_response(
+                context, **response_kwargs)
+        if self.get_deferred():
+            job = await sync_to_async(self.start_job)(context,
+                                                      **response_kwargs)
+            return await sync_to_async(self.get_job_response)(job)
+        if await sync_to_async(self.use_chunks)(context):
+            sources = await sync_to_async(self.render_chunks)(
+                context, **response_kwargs)
+            doc = await self.acompile_chunks(sources)
+            response = await sync_to_async(self.get_pdf_response)(doc)
+            if response.status_code == 200:
+                self._augment_response(response, self.get_filename(doc))
+            return response
+        return await super(AsyncLaTeXListView, self).arender_to_response(
+            context, **response_kwargs)
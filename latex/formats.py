@@ -0,0 +1,269 @@
+"""
+A cache of precompiled ("dumped") TeX formats, one per distinct preamble.
+
+Loading packages usually dominates the run time of short documents.
+Once the same preamble (everything before ``\\begin{document}``, except
+the ``\\title``, ``\\author`` and ``\\date``, which are left to the body
+so that documents differing only in those share a format) has been seen
+``min_uses`` times, it is dumped into a format file with
+``<engine> -ini "&<engine>"``; later documents with that preamble are
+compiled with ``-fmt`` and only their body is processed.
+
+Caveat: preambles that open output files (makeidx, glossaries, ...)
+cannot be dumped; such a dump or the compile against it fails, and
+``LaTeX_Document`` then falls back to an ordinary compile.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+import re
+import shlex
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .latex_document import EngineAborted, run_engine
+
+#######################
+
+DEFAULT_FORMAT_DIR = os.path.join(tempfile.gettempdir(),
+                                  'python-latex-formats')
+BEGIN_DOCUMENT = '\\begin{document}'
+# as rendered by LaTeX_Document.authortitle(), after the preamble.
+TITLE_REXP = re.compile(r'^\\(?:title|author|date)\{', re.MULTILINE)
+
+#######################
+
+
+def split_preamble(source):
+    """
+    Split ``source`` into (preamble, body) at the first
+    ``\\begin{document}``; returns None if there is no such line.
+    """
+    index = source.find(BEGIN_DOCUMENT)
+    if index == -1:
+        return None
+    return source[:index], source[index:]
+
+
+def split_format(source):
+    """
+    Split ``source`` into (preamble, body) for dumping: as
+    split_preamble(), but the preamble stops at the first ``\\title``,
+    ``\\author`` or ``\\date``, which go with the body.
+    """
+    parts = split_preamble(source)
+    if parts is None:
+        return None
+    preamble, body = parts
+    title = TITLE_REXP.search(preamble)
+    if title is None:
+        return parts
+    return preamble[:title.start()], preamble[title.start():] + body
+
+
+class FormatCache(object):
+    """
+    FormatCache(directory=None, min_uses=2, max_entries=32, max_seen=1024)
+
+    Format files are named ``<key>.fmt`` in ``directory``, where the key
+    is a hash of the preamble and the engine command line.  At most
+    ``max_entries`` formats are kept; the least recently used are
+    removed first.  Preambles that failed to dump (or took longer than
+    ``dump_timeout`` seconds) are not retried.  Uses are counted for
+    the ``max_seen`` most recently seen preambles.
+
+    Useful methods:
+        * get(source, command, timeout)  -- returns (format_name, body) or None
+        * environ()             -- environment for the engine process
+        * stats()
+    """
+    dump_timeout = 120
+
+    def __init__(self, directory=None, min_uses=2, max_entries=32,
+                 max_seen=1024):
+        if directory is None:
+            directory = DEFAULT_FORMAT_DIR
+        self.directory = directory
+        self.min_uses = min_uses
+        self.max_entries = max_entries
+        self.max_seen = max_seen
+        self.hits = 0
+        self.misses = 0
+        self.dumps = 0
+        self._seen = OrderedDict()  # key: [uses, lock], least recent first
+        self._failed = set()
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, preamble, command):
+        h = hashlib.sha256()
+        h.update(command.encode('utf-8'))
+        h.update(b'\0')
+        h.update(preamble.encode('utf-8', 'replace'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.fmt')
+
+    def _use(self, key):
+        """
+        Count a use of ``key``; returns (uses, lock), the lock being
+        held while its format is dumped.
+        """
+        with self._lock:
+            seen = self._seen.pop(key, None)
+            if seen is None:
+                seen = [0, threading.Lock()]
+                while len(self._seen) >= self.max_seen:
+                    # at worst, a preamble forgotten mid-dump is dumped twice.
+                    self._seen.popitem(last=False)
+            seen[0] += 1
+            self._seen[key] = seen
+            return seen[0], seen[1]
+
+    def get(self, source, command, timeout=None):
+        """
+        Return ``(format_name, body)`` if ``source`` can be compiled
+        against a dumped format, dumping it first (within ``timeout``
+        seconds, if given) if its preamble has now been seen often
+        enough.  Otherwise (or if another thread is still dumping it
+        when ``timeout`` runs out) return None.
+        """
+        parts = split_format(source)
+        if parts is None:
+            return None
+        preamble, body = parts
+        key = self.key(preamble, command)
+        with self._lock:
+            if key in self._failed:
+                return None
+        uses, key_lock = self._use(key)
+        started = time.time()
+        if timeout is None:
+            acquired = key_lock.acquire()
+        else:
+            acquired = key_lock.acquire(timeout=max(timeout, 0))
+        if not acquired:
+            # another thread is dumping it: compile without the format.
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            if not os.path.exists(self._path(key)):
+                if timeout is not None:
+                    timeout -= time.time() - started
+                if uses < self.min_uses or \
+                        not self.dump(key, preamble, command, timeout):
+                    with self._lock:
+                        self.misses += 1
+                    return None
+            try:
+                os.utime(self._path(key), None)
+            except OSError:     # evicted by another process
+                return None
+        finally:
+            key_lock.release()
+        with self._lock:
+            self.hits += 1
+        return key, body
+
+    def dump(self, key, preamble, command, timeout=None):
+        """
+        Dump ``preamble`` into the format file for ``key``, within
+        ``timeout`` seconds (and at most ``dump_timeout``).
+        Returns True on success.
+        """
+        cut_short = timeout is not None and timeout < self.dump_timeout
+        if not cut_short:
+            timeout = self.dump_timeout
+        if timeout <= 0:
+            return False
+        args = shlex.split(command)
+        engine = os.path.basename(args[0])
+        fd, ini_name = tempfile.mkstemp(suffix='.tex', dir=self.directory)
+        jobname = os.path.splitext(os.path.basename(ini_name))[0]
+        with os.fdopen(fd, 'wb') as f:
+            f.write(preamble.encode('utf-8', 'replace'))
+            f.write(b'\n\\dump\n')
+        args += ['-ini', '-jobname=%s' % jobname, '&%s' % engine,
+                 os.path.basename(ini_name)]
+        try:
+            try:
+                run_engine(args, self.directory, timeout=timeout)
+            except EngineAborted:
+                # only a dump that took its full time is a lost cause.
+                if not cut_short:
+                    self.mark_failed(key)
+                return False
+            fmt_name = os.path.join(self.directory, jobname + '.fmt')
+            if not os.path.exists(fmt_name):
+                self.mark_failed(key)
+                return False
+            os.rename(fmt_name, self._path(key))
+        finally:
+            base = os.path.splitext(ini_name)[0]
+            for extension in ('.tex', '.log'):
+                try:
+                    os.remove(base + extension)
+                except OSError:
+                    pass
+        with self._lock:
+            self.dumps += 1
+        self.evict()
+        return True
+
+    def mark_failed(self, key):
+        """
+        Stop using (and trying to dump) the format for ``key``.
+        """
+        with self._lock:
+            self._failed.add(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def environ(self, env=None):
+        """
+        Return a copy of ``env`` (by default, the process environment)
+        in which the engine will find the formats in this cache (as
+        well as the system ones).
+        """
+        env = dict(os.environ if env is None else env)
+        env['TEXFORMATS'] = self.directory + os.pathsep + \
+            env.get('TEXFORMATS', '')
+        return env
+
+    def _entries(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            key, extension = os.path.splitext(filename)
+            if extension != '.fmt':
+                continue
+            try:
+                entries.append((os.path.getmtime(self._path(key)), key))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        entries.sort()
+        for mtime, key in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'dumps': self.dumps,
+            'formats': len(self._entries()),
+        }
@@ -0,0 +1,76 @@
+"""
+Instrumentation hooks, e.g., for exporting compile latencies.
+
+Connect a receiver (any callable) to one of the hooks below; it is
+called as ``receiver(sender, **kwargs)`` each time the hook is sent:
+
+    from latex import hooks
+
+    @hooks.compile_finished.connect
+    def observe(sender, result, error, **kwargs):
+        histogram.observe(result.total_time)
+
+Receivers should accept extra keyword arguments, as more may be added.
+They are called in the thread doing the work, so keep them fast; an
+exception raised by a receiver propagates to the caller.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import threading
+
+#######################
+
+
+class Hook(object):
+    """
+    Hook(name)
+
+    A list of receivers, called in the order they were connected.
+
+    Useful methods:
+        * connect(receiver)     -- also usable as a decorator
+        * disconnect(receiver)
+        * send(sender, **kwargs)
+    """
+    def __init__(self, name):
+        self.name = name
+        self._receivers = ()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Hook %s>' % self.name
+
+    def connect(self, receiver):
+        with self._lock:
+            if receiver not in self._receivers:
+                # replaced, not changed, so send() needs no lock.
+                self._receivers = self._receivers + (receiver, )
+        return receiver
+
+    def disconnect(self, receiver):
+        with self._lock:
+            self._receivers = tuple(r for r in self._receivers
+                                    if r != receiver)
+
+    def has_receivers(self):
+        return bool(self._receivers)
+
+    def send(self, sender, **kwargs):
+        for receiver in self._receivers:
+            receiver(sender, **kwargs)
+
+
+#######################
+
+# sender: the LaTeX_Document; kwargs: result (the CompileResult so far)
+compile_started = Hook('compile_started')
+# after each engine pass; kwargs: result, seconds (for this pass)
+compile_pass = Hook('compile_pass')
+# kwargs: result, error (the exception raised, or None)
+compile_finished = Hook('compile_finished')
+
+# sender: the class of the view; kwargs: view, request
+response_started = Hook('response_started')
+# kwargs: view, request, response, seconds
+response_finished = Hook('response_finished')
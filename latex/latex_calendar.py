@@ -3,6 +3,13 @@
 """
 latex_calendar.py
 
+Usage:
+    python -m latex.latex_calendar [YEAR ...]
+        print the LaTeX source of a calendar for each YEAR.
+    python -m latex.latex_calendar --pdf DIR [--jobs N] [--merge] YEAR ...
+        compile a PDF calendar per YEAR (YEAR may be a range, e.g.,
+        2020-2029) in parallel, into DIR, and report the time for each.
+
 From: http://www.gov.mb.ca/ctt/invest/busfacts/workforce/stat_hols.html
 on: 2009-May-29
 
@@ -27,9 +34,16 @@ TODO: convert this to dateutil, which makes all the calendar computations easier
 #######################
 from __future__ import print_function, unicode_literals
 
+import argparse
 import calendar
 import datetime
+import os
+import shutil
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import OrderedDict
 
 #######################
 
@@ -93,62 +107,117 @@ def is_nth_day(d, n, weekday):
 
 
 
-def is_holiday(d):
+def nth_weekday(year, month, n, weekday):
     """
-    if the date object d is holiday, return a description, otherwise return None.
+    Return the date of the ``n``-th ``weekday`` of the month.
     """
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta(
+        days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
 
-    # stat holidays
-    if d.month == 1 and d.day == 1:
-        return 'New Year\'s Day'
-    if d.month == 2 and is_nth_day(d, 3, MONDAY): #d.weekday() == 0 and (1+(3-1)*7+0 <= d.day <= 0+3*7+0):
-        # 3rd (3 in *7 factors) monday (final +0)
-        return 'Louis Riel Day'
-    if d == calc_easter(d.year) - datetime.timedelta(days=2):
-        return 'Good Friday'
-    if d == calc_easter(d.year):
-        return 'Easter Sunday'
-    if d.month == 5 and d.weekday() == 0 and (25-7 <= d.day < 25):
-        # monday on or before May 24
-        return 'Victoria Day'
-    if d.month == 7 and d.day == 1:
-        return 'Canada Day'
-    if d.month == 9 and is_nth_day(d, 1, MONDAY): #d.weekday() == 0 and (1+(1-1)*7+0 <= d.day <= 0+1*7+0):
-        # 1st (1 in *7 factors) monday (final +0)
-        return 'Labour Day'
-    if d.month == 10 and is_nth_day(d, 2, MONDAY): #d.weekday() == 0 and (1+(2-1)*7+0 <= d.day <= 0+2*7+0):
-        # 2nd (2 in *7 factors) monday (final +0)
-        return 'Thanksgiving Day'
-    if d.month == 11 and d.day == 11:
-        return 'Rememberance Day'
-    if d.month == 12 and d.day == 25:
-        return 'Christmas Day'
 
-    # federal holidays
-    if d == calc_easter(d.year) + datetime.timedelta(days=1):
-        return grayed_out('Easter Monday')
-    if d.month == 12 and d.day == 24:
-        return grayed_out('Christmas Eve')
-    if d.month == 12 and d.day == 26:
-        return grayed_out('Boxing Day')
-    if d.month == 8 and is_nth_day(d, 1, MONDAY):
-        return grayed_out('Terry Fox Day')
+# Holiday rules are functions of the year, returning a list of
+# (date, description) pairs.
+
+def fixed_date(month, day, label):
+    def rule(year):
+        return [(datetime.date(year, month, day), label)]
+    return rule
+
+
+def nth_weekday_of(month, n, weekday, label):
+    def rule(year):
+        return [(nth_weekday(year, month, n, weekday), label)]
+    return rule
+
+
+def easter_offset(days, label):
+    def rule(year):
+        return [(calc_easter(year) + datetime.timedelta(days=days), label)]
+    return rule
+
+
+def monday_before(month, day, label):
+    def rule(year):
+        d = datetime.date(year, month, day) - datetime.timedelta(days=1)
+        return [(d - datetime.timedelta(days=d.weekday()), label)]
+    return rule
 
+
+# in order of precedence
+MANITOBA_HOLIDAYS = (
+    # stat holidays
+    fixed_date(1, 1, 'New Year\'s Day'),
+    nth_weekday_of(2, 3, MONDAY, 'Louis Riel Day'),
+    easter_offset(-2, 'Good Friday'),
+    easter_offset(0, 'Easter Sunday'),
+    monday_before(5, 25, 'Victoria Day'),
+    fixed_date(7, 1, 'Canada Day'),
+    nth_weekday_of(9, 1, MONDAY, 'Labour Day'),
+    nth_weekday_of(10, 2, MONDAY, 'Thanksgiving Day'),
+    fixed_date(11, 11, 'Rememberance Day'),
+    fixed_date(12, 25, 'Christmas Day'),
+    # federal holidays
+    easter_offset(1, grayed_out('Easter Monday')),
+    fixed_date(12, 24, grayed_out('Christmas Eve')),
+    fixed_date(12, 26, grayed_out('Boxing Day')),
+    nth_weekday_of(8, 1, MONDAY, grayed_out('Terry Fox Day')),
     # other holidays
-    if d.month == 3 and d.day == 17:
-        return grayed_out('St.\ Patrick\'s Day')
-    if d.month == 2 and d.day == 14:
-        return grayed_out('Valentine\'s Day')
-    if d.month == 5 and is_nth_day(d, 2, SUNDAY):
-        return grayed_out('Mother\'s Day')
-    if d.month == 6 and is_nth_day(d, 3, SUNDAY):
-        return grayed_out('Father\'s Day')
-    if d.month == 10 and d.day == 31:
-        return grayed_out('Halloween')
-    if d.month == 12 and d.day == 31:
-        return grayed_out('New Year\'s Eve')
+    fixed_date(3, 17, grayed_out('St.\ Patrick\'s Day')),
+    fixed_date(2, 14, grayed_out('Valentine\'s Day')),
+    nth_weekday_of(5, 2, SUNDAY, grayed_out('Mother\'s Day')),
+    nth_weekday_of(6, 3, SUNDAY, grayed_out('Father\'s Day')),
+    fixed_date(10, 31, grayed_out('Halloween')),
+    fixed_date(12, 31, grayed_out('New Year\'s Eve')),
+    )
+
+
+class HolidayCalendar(object):
+    """
+    HolidayCalendar(rules=MANITOBA_HOLIDAYS, max_years=64)
+
+    Looks up holidays in a {date: description} index, built once per
+    year from ``rules``; earlier rules take precedence over later ones
+    on the same date.  At most ``max_years`` indexes are kept, the least
+    recently used are dropped first.
+    """
+    def __init__(self, rules=MANITOBA_HOLIDAYS, max_years=64):
+        self.rules = tuple(rules)
+        self.max_years = max_years
+        self._years = OrderedDict()
+        self._lock = threading.Lock()
+
+    def holidays(self, year):
+        """
+        Return the {date: description} index for ``year``.
+        """
+        with self._lock:
+            index = self._years.pop(year, None)
+            if index is None:
+                index = {}
+                for rule in self.rules:
+                    for d, label in rule(year):
+                        index.setdefault(d, label)
+            self._years[year] = index
+            while len(self._years) > self.max_years:
+                self._years.popitem(last=False)
+            return index
+
+    def get(self, d):
+        """
+        if the date object d is holiday, return a description, otherwise return None.
+        """
+        return self.holidays(d.year).get(d)
+
+
+default_calendar = HolidayCalendar()
 
-    return None
+
+def is_holiday(d):
+    """
+    if the date object d is holiday, return a description, otherwise return None.
+    """
+    return default_calendar.get(d)
 
 
 
@@ -218,9 +287,11 @@ def do_day_seperator():
     return ' & '
 
 
-def do_day(month,d):
+def do_day(month,d, holidays=None):
     if month == d.month:
-        holiday = is_holiday(d)
+        if holidays is None:
+            holidays = default_calendar
+        holiday = holidays.get(d)
         if holiday is not None:
             return '\\holidayformat{%d}{%s}' % (d.day, holiday)
         return '\\cellformat{%d}' % d.day
@@ -242,29 +313,37 @@ def do_day_names(firstday):
     return result
 
 
-def do_month(year, month):
-    # return a "page" of latex for this year / month
+def iter_month(year, month, holidays=None):
+    # yield a "page" of latex for this year / month, in pieces
     d = datetime.date(year, month, 1)
     month_banner = d.strftime('%B %Y')
-    result = do_begin_month(month_banner)
-    result += do_day_names(calendar.SUNDAY)
+    yield do_begin_month(month_banner)
+    yield do_day_names(calendar.SUNDAY)
     monthdays = calendar.Calendar(calendar.SUNDAY).monthdatescalendar(year, month)
     for week in monthdays:
         last = False
         if week == monthdays[-1]:
             last = True
-        result += do_begin_week(last=last)
-        result += do_day_seperator().join([do_day(month,day) for day in week])
-        result += do_end_week(last=last)
-    result += do_end_month()
+        yield do_begin_week(last=last)
+        yield do_day_seperator().join([do_day(month,day,holidays) for day in week])
+        yield do_end_week(last=last)
+    yield do_end_month()
 
-    return result
+
+def do_month(year, month, holidays=None):
+    # return a "page" of latex for this year / month
+    return ''.join(iter_month(year, month, holidays))
 
 
 
 
 
-def main(years=None, months=None):
+def iter_calendar(years=None, months=None, holidays=None):
+    """
+    Yield the LaTeX source of a calendar, one piece at a time.
+    ``years`` and ``months`` may be lists or single values; by default,
+    the rest of the current year, or all months of the given years.
+    """
     if isinstance(years, int):
         years = [years,]
     if isinstance(months, int):
@@ -277,18 +356,118 @@ def main(years=None, months=None):
             months = range(1, 13)
     if years is None:
         years = [today.year,]
-    result = do_begin_document()
+    yield do_begin_document()
     for year in years:
         for month in months:
-            result += do_month(year, month)
-    result += do_end_document()
-    return result
+            for piece in iter_month(year, month, holidays):
+                yield piece
+    yield do_end_document()
+
+
+def write_calendar(fp, years=None, months=None, holidays=None):
+    """
+    Write the LaTeX source of a calendar to the file-like ``fp``
+    as it is generated; see iter_calendar().
+    """
+    for piece in iter_calendar(years, months, holidays):
+        fp.write(piece)
+
+
+def main(years=None, months=None, holidays=None):
+    return ''.join(iter_calendar(years, months, holidays))
+
+
+def build_pdf(year, output_dir, months=None):
+    """
+    Compile the calendar for ``year`` to ``output_dir``/calendar-YEAR.pdf.
+    Returns (year, filename, pages, seconds, log); filename is None if
+    the compile failed.
+    """
+    from .latex_document import LaTeX_Document
+    start = time.time()
+    doc = LaTeX_Document()
+    doc.source = main(year, months)
+    filename = None
+    if doc.compile():
+        filename = os.path.join(output_dir, 'calendar-%d.pdf' % year)
+        shutil.copyfile(doc._out_file, filename)
+    log = doc.log
+    pages = doc.pages
+    doc.cleanup()
+    return year, filename, pages, time.time() - start, log
+
+
+def build_pdfs(years, output_dir, months=None, jobs=None, merge=False):
+    """
+    Compile one calendar per year with build_pdf(), on a pool of ``jobs``
+    processes, reporting on stderr as each finishes.  With ``merge``,
+    the years are also concatenated into ``output_dir``/calendar.pdf.
+    Returns the list of build_pdf() results, in the order of ``years``.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    start = time.time()
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(build_pdf, year, output_dir, months)
+                   for year in years]
+        for future in as_completed(futures):
+            year, filename, pages, seconds, log = future.result()
+            results[year] = (year, filename, pages, seconds, log)
+            if filename is None:
+                print('%d: FAILED (%.2fs)\n%s' % (year, seconds, log),
+                      file=sys.stderr)
+            else:
+                print('%d: %s (%s pages, %.2fs)' % (year, filename, pages,
+                                                   seconds), file=sys.stderr)
+    results = [results[year] for year in years]
+    if merge:
+        from .latex_document import LaTeX_Document, merge_source
+        filenames = [r[1] for r in results if r[1] is not None]
+        doc = LaTeX_Document()
+        doc.source = merge_source(filenames)
+        merge_start = time.time()
+        if doc.compile(extra_assets=filenames):
+            filename = os.path.join(output_dir, 'calendar.pdf')
+            shutil.copyfile(doc._out_file, filename)
+            print('merged: %s (%s pages, %.2fs)' % (
+                filename, doc.pages, time.time() - merge_start),
+                file=sys.stderr)
+        else:
+            print('merged: FAILED\n%s' % doc.log, file=sys.stderr)
+        doc.cleanup()
+    print('total: %.2fs' % (time.time() - start), file=sys.stderr)
+    return results
+
+
+def _years(arg):
+    if '-' in arg[1:]:
+        first, last = arg.split('-', 1)
+        return list(range(int(first), int(last) + 1))
+    return [int(arg)]
 
 
 if __name__ == '__main__':
-    if not sys.argv[1:]:
-        print(main(datetime.date.today().year))
+    parser = argparse.ArgumentParser(description='LaTeX calendars')
+    parser.add_argument('years', nargs='*', help='a year, or a range of years')
+    parser.add_argument('--pdf', metavar='DIR',
+                        help='compile a PDF per year into DIR')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of parallel compiles (default: CPUs)')
+    parser.add_argument('--merge', action='store_true',
+                        help='also merge the years into DIR/calendar.pdf')
+    args = parser.parse_args()
+    years = [year for arg in args.years for year in _years(arg)]
+    if args.pdf:
+        if not years:
+            years = [datetime.date.today().year]
+        results = build_pdfs(years, args.pdf, jobs=args.jobs,
+                             merge=args.merge)
+        sys.exit(0 if all(r[1] is not None for r in results) else 1)
+    if not years:
+        write_calendar(sys.stdout, datetime.date.today().year)
+        print()
     else:
-        for arg in sys.argv[1:]:
-            year = int(arg)
-            print(main(year))
+        for year in years:
+            write_calendar(sys.stdout, year)
+            print()
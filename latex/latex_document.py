@@ -2,16 +2,250 @@
 #######################
 from __future__ import print_function, unicode_literals
 
+import asyncio
+import codecs
+import hashlib
+import io
 import os
 import re
+import shlex
 import shutil
+import signal
+import subprocess
 import sys
-from glob import glob
-from tempfile import NamedTemporaryFile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tempfile import TemporaryFile
+
+try:
+    import resource
+except ImportError:     # not on Windows
+    resource = None
+
+from . import hooks
+from .cache import source_hasher, update_assets
+from .workspace import Workspace
 
 #######################
 
 
+class EngineAborted(Exception):
+    """
+    Raised by run_engine() when the engine is stopped: ``reason`` is
+    'timeout' if it was still running at its deadline, or 'limit' if
+    it was killed by a resource limit.  ``output`` holds the lines it
+    wrote until then.
+    """
+    def __init__(self, reason, output):
+        Exception.__init__(self, 'TeX engine stopped (%s)' % reason)
+        self.reason = reason
+        self.output = output
+
+
+# sets the limits given in argv[1] ("rlimit=value,..."), then becomes
+# the engine; unlike a preexec_fn, safe to start from any thread.  The
+# signals python ignores are reset, so that the engine is killed at a
+# file size limit, as it would be if started directly.
+_LIMITS_SHIM = (
+    'import os, resource, signal, sys\n'
+    'signal.signal(signal.SIGPIPE, signal.SIG_DFL)\n'
+    'signal.signal(signal.SIGXFSZ, signal.SIG_DFL)\n'
+    'for item in sys.argv[1].split(","):\n'
+    '    rlimit, value = [int(n) for n in item.split("=")]\n'
+    '    resource.setrlimit(rlimit, (value, value))\n'
+    'try:\n'
+    '    os.execvp(sys.argv[2], sys.argv[2:])\n'
+    'except OSError as e:\n'
+    '    sys.stderr.write("cannot run %s: %s\\n" % (sys.argv[2], e))\n'
+    '    sys.exit(127)\n'
+)
+
+
+def _limited(args, limits):
+    """
+    Return the command to run ``args`` with the ``limits`` (a dict of
+    {resource.RLIMIT_*: value}) set.
+    """
+    if not limits:
+        return args
+    spec = ','.join('%d=%d' % item for item in sorted(limits.items()))
+    return [sys.executable, '-E', '-S', '-c', _LIMITS_SHIM, spec] + list(args)
+
+
+def _process_kwargs():
+    if os.name != 'posix':
+        return {}
+    # a session of its own, so that everything TeX starts can be killed.
+    return {'start_new_session': True}
+
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        process.kill()
+
+
+def _engine_output(output, returncode, limits, max_output_bytes):
+    """
+    Read back the engine ``output`` file, as a list of lines.
+    """
+    output.seek(0)
+    data = output.read(max_output_bytes) if max_output_bytes else \
+        output.read()
+    lines = data.decode('utf-8', 'replace').splitlines(True)
+    if returncode < 0 and limits:
+        # killed by a signal: SIGXCPU, SIGXFSZ or SIGKILL at a hard limit.
+        raise EngineAborted('limit', lines)
+    return lines
+
+
+def run_engine(args, working_dir, env=None, timeout=None, limits=None,
+               max_output_bytes=None):
+    """
+    Run the TeX engine command ``args`` (a list) in ``working_dir``,
+    and return its output as a list of lines.  The process working
+    directory is never changed, so this is safe to call from several
+    threads at once.
+
+    The engine gets ``timeout`` seconds, after which it is killed along
+    with any process it started; ``limits`` are resource limits to run
+    it with (see LaTeX_Document.engine_limits()), and at most
+    ``max_output_bytes`` of its output are read.  EngineAborted is
+    raised if it is stopped.
+    """
+    with TemporaryFile() as output:
+        process = subprocess.Popen(_limited(args, limits),
+                                   cwd=working_dir, env=env,
+                                   stdin=subprocess.DEVNULL,
+                                   stdout=output,
+                                   stderr=subprocess.STDOUT,
+                                   **_process_kwargs())
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            _kill(process)
+            process.wait()
+            raise EngineAborted('timeout', _engine_output(
+                output, 0, None, max_output_bytes))
+        return _engine_output(output, process.returncode, limits,
+                              max_output_bytes)
+
+
+async def run_engine_async(args, working_dir, env=None, timeout=None,
+                           limits=None, max_output_bytes=None):
+    """
+    As ``run_engine()``, but runs as an asyncio subprocess so the
+    event loop is free while TeX is working.
+    """
+    with TemporaryFile() as output:
+        process = await asyncio.create_subprocess_exec(
+            *_limited(args, limits), cwd=working_dir, env=env,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=output,
+            stderr=asyncio.subprocess.STDOUT,
+            **_process_kwargs())
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            _kill(process)
+            await process.wait()
+            raise EngineAborted('timeout', _engine_output(
+                output, 0, None, max_output_bytes))
+        return _engine_output(output, process.returncode, limits,
+                              max_output_bytes)
+
+
+class OutputFile(io.FileIO):
+    """
+    A read-only handle on a compiled PDF.  ``on_close`` is called once,
+    after the file is closed; it is how LaTeX_Document.open_output()
+    ties the cleanup of the temporary files to the end of a download.
+    Being a real file, it can be passed to sendfile().
+    """
+    def __init__(self, name, on_close=None):
+        io.FileIO.__init__(self, name, 'rb')
+        self._on_close = on_close
+
+    def close(self):
+        try:
+            io.FileIO.close(self)
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
+
+class CompileResult(object):
+    """
+    The outcome of LaTeX_Document.compile(); true if there is output.
+
+    Attributes:
+        * success       -- True if the compile produced output
+        * cached        -- True if the output came from the cache
+        * service       -- True if compiled by the ``latex.daemon`` service
+        * aborted       -- 'timeout' or 'limit' if the engine was stopped
+        * format        -- the dumped format used, or None
+        * passes        -- the number of engine passes
+        * pass_times    -- the wall-clock seconds of each pass
+        * pages, output_bytes   -- from the "Output written on" line
+        * asset_time    -- seconds spent copying the extra assets
+        * restored      -- the number of files restored from a build store
+        * total_time    -- seconds for the whole compile
+        * log
+    """
+    def __init__(self):
+        self.success = False
+        self.cached = False
+        self.service = False
+        self.aborted = None
+        self.format = None
+        self.passes = 0
+        self.pass_times = []
+        self.pages = None
+        self.output_bytes = None
+        self.asset_time = 0.0
+        self.restored = 0
+        self.total_time = None
+        self.log = None
+
+    def __bool__(self):
+        return bool(self.success)
+
+    @property
+    def timed_out(self):
+        return self.aborted == 'timeout'
+
+    def __repr__(self):
+        return '<CompileResult success=%r passes=%d pages=%r time=%r>' % (
+            self.success, self.passes, self.pages, self.total_time)
+
+
+DOCUMENT_END = u'\n\\end{document}\n'
+
+
+def _package_options(options):
+    # a set has no order of its own: sort it, so equal sets render alike.
+    if isinstance(options, (set, frozenset)):
+        return u','.join(sorted(options))
+    if isinstance(options, (list, tuple)):
+        return u','.join(options)
+    return options
+
+
+def render_packages(packages):
+    """
+    Return the ``\\usepackage`` lines for ``packages``, a dict (or a
+    sequence of pairs) of {package: options}, in order.  The options
+    may be a string, or a list, tuple or set of options.
+    """
+    if hasattr(packages, 'items'):
+        packages = packages.items()
+    return u''.join(
+        u'\\usepackage[%s]{%s}\n' % (_package_options(options), package)
+        if options else u'\\usepackage{%s}\n' % package
+        for package, options in packages)
 
 
 class LaTeX_Document:
@@ -24,15 +258,69 @@ class LaTeX_Document:
         extra_preamble=None
         )
 
-    Construct a compilable document.
+    Construct a compilable document.  Each compile runs in a workspace,
+    a directory of its own in ``scratch_dir`` (by default, from the
+    environment variable LATEX_SCRATCH_DIR, or the system temporary
+    directory; ``/dev/shm`` keeps it in memory), which is removed by
+    ``cleanup()``.  Use the document in a ``with`` statement to clean
+    up at the end of the block.
 
     Useful methods:
-        * compile()
+        * compile()         -- returns a CompileResult
+        * compile_async()   -- awaitable version of compile()
         * render_src()  -- used to cast as str() or "{}".format()
+        * render_header()   -- the source up to the body
         * preview()
         * pdf_data()
+        * open_output()     -- file handle on the PDF, for streaming
+        * cleanup()         -- remove the workspace now
         * set_full_src(text)    -- set source code
+        * write_source(chunks)  -- stream source code to the source file
+
+    Set ``cache`` to a ``latex.cache.PDFCache`` (on the class or on an
+    instance) to reuse the output of identical earlier compiles.
+
+    The engine is rerun only while the auxiliary files (see
+    ``aux_extensions``) are still changing, and never more than
+    ``max_passes`` times; ``passes`` gives the count for the last compile.
+    ``result`` holds the CompileResult of the last compile, with its
+    timings; the hooks in ``latex.hooks`` are sent as compiles progress.
+
+    Set ``format_cache`` to a ``latex.formats.FormatCache`` to compile
+    documents with a frequently repeated preamble against a dumped format.
+
+    Set ``asset_store`` to a ``latex.assets.AssetStore`` to have the
+    engine find the extra assets in the store (through ``TEXINPUTS``)
+    rather than copy them next to the source for every compile.
+
+    Set ``build_store`` to a ``latex.builds.BuildStore`` and give the
+    document a ``build_id`` (a stable id, e.g., of the record it shows)
+    to start each compile from the auxiliary files of the previous
+    successful compile with that id, so that it needs fewer passes.
+
+    If ``compile_socket`` is set (by default, from the environment
+    variable LATEX_COMPILE_SOCKET), documents are compiled by the
+    ``latex.daemon`` service listening there rather than locally.
+
+    Set ``timeout`` (seconds, for the whole compile), ``cpu_limit``
+    (seconds), ``memory_limit`` and ``max_output_bytes`` (bytes, for
+    each file written and for the output read) to bound each compile;
+    a compile that goes over fails, with ``result.aborted`` set.
     """
+    latex_command = u'pdflatex -interaction=nonstopmode'
+    cache = None
+    format_cache = None
+    asset_store = None
+    build_store = None
+    scratch_dir = os.environ.get('LATEX_SCRATCH_DIR') or None
+    compile_socket = os.environ.get('LATEX_COMPILE_SOCKET') or None
+    max_passes = 5
+    timeout = None
+    cpu_limit = None
+    memory_limit = None
+    max_output_bytes = None
+    aux_extensions = (u'.aux', u'.toc', u'.out')
+
     def __init__(self, document_body=None, title=None, author=None, date=None,
                  packages={}, preamble_extras=None):
         self._title = title
@@ -41,62 +329,128 @@ class LaTeX_Document:
         self._packages = packages
         self._preamble_extras = preamble_extras
         self._body = document_body
+        self.build_id = None
 
+        self._workspace = None
         self._src_file = None
         self._out_file = None
         self._compiled = False
         self._log = None
+        self._cache_key = None
+        self._result = None
+        self._streamed = None
+        self._streamed_lost = False
         self.full_src = None
 
     def documentclass(self):
         return u'\\documentclass[12pt,letterpaper]{article}\n'
 
     def packages(self):
-        results = ''
-        for package, options in self._packages.items():
-            if options:
-                results += u'\\usepackage[%s]{%s}\n' % (options, package)
-            else:
-                results += u'\\usepackage{%s}\n' % package
-        return results
+        return render_packages(self._packages)
 
     def preamble(self):
-        results = u''
-        results += self.packages()
-        if self._preamble_extras:
-            results += self._preamble_extras
-        return results
+        return u''.join([self.packages(), self._preamble_extras or u''])
 
     def authortitle(self):
-        results = u''
+        parts = []
         if self._title:
-            results += u'\\title{%s}\n' % self._title
+            parts.append(u'\\title{%s}\n' % self._title)
         if self._author:
-            results += u'\\author{%s}\n' % self._author
+            parts.append(u'\\author{%s}\n' % self._author)
         if self._date:
-            results += u'\\date{%s}\n' % self._date
-        return results
+            parts.append(u'\\date{%s}\n' % self._date)
+        return u''.join(parts)
+
+    def render_header(self):
+        """
+        The source up to the body: the same for any body.
+        """
+        parts = [self.documentclass(), self.preamble(), self.authortitle(),
+                 u'\\begin{document}\n']
+        if self._author or self._title:
+            parts.append(u'\\maketitle\n')
+        return u''.join(parts)
 
     def render_src(self):
         if self.full_src is None:
-            results = self.documentclass()
-            results += self.preamble()
-            results += self.authortitle()
-            results += u'\\begin{document}\n'
-            if self._author or self._title:
-                results += u'\\maketitle\n'
-            results += "{}".format(self._body)
-            results += u'\n\\end{document}\n'
-            self.full_src = results
+            if self._streamed is not None:
+                # read back, not kept: a streamed source may be huge.
+                self._src_file.seek(0)
+                return self._src_file.read().decode('utf-8', 'replace')
+            if self._streamed_lost:
+                raise ValueError('the streamed source was removed by '
+                                 'cleanup(); write it again to compile')
+            self.full_src = u''.join([self.render_header(),
+                                      "{}".format(self._body),
+                                      DOCUMENT_END])
         return self.full_src
 
     def set_full_src(self, text):
         self.full_src = text
+        self._streamed = None
+        self._streamed_lost = False
+
+    def write_source(self, chunks):
+        """
+        Set the source from an iterable of text ``chunks``, which are
+        written to the source file as they come, so the whole source is
+        never held in memory.  Dumped formats are not used for such a
+        source, and a compile service needs it read back in.
+        """
+        self._new_source_file()
+        self.full_src = None
+        self._streamed_lost = True  # until the whole source is written
+        encoder = codecs.getincrementalencoder('utf-8')('replace')
+        hasher = source_hasher(self.latex_command)
+        for chunk in chunks:
+            data = encoder.encode(chunk)
+            hasher.update(data)
+            self._src_file.write(data)
+        data = encoder.encode(u'', True)
+        hasher.update(data)
+        self._src_file.write(data)
+        self._src_file.flush()
+        self._streamed = hasher
+        self._streamed_lost = False
+
+    def _new_source_file(self):
+        """
+        Replace the workspace (and the files of any earlier compile)
+        with a new one, holding an empty source file.
+        """
+        self.cleanup()
+        self._workspace = Workspace(self.scratch_dir)
+        self._src_file = open(
+            self._workspace.filename(self._workspace.name + u'.tex'), 'w+b')
+
+    def _discard_output(self):
+        """
+        Remove the output of an earlier compile in the workspace: it may
+        be a hard link to a cache entry, which must not be written to.
+        """
+        self._out_file = None
+        try:
+            os.remove(os.path.splitext(self._src_file.name)[0] + u'.pdf')
+        except OSError:
+            pass
+
+    def source_digest(self, extra_assets=[]):
+        """
+        Returns the hex digest identifying a compile of this document
+        with ``extra_assets``; see ``latex.cache.source_digest()``.
+        """
+        if self._streamed is not None:
+            hasher = self._streamed.copy()
+        else:
+            hasher = source_hasher(self.latex_command)
+            hasher.update(self.source.encode('utf-8', 'replace'))
+        if self.asset_store is not None:
+            return self.asset_store.update_hash(hasher,
+                                                extra_assets).hexdigest()
+        return update_assets(hasher, extra_assets).hexdigest()
 
     def __str__(self):
-        if self.full_src is None:
-            self.render_src()
-        return self.full_src
+        return self.render_src()
 
 
 #     def __unicode__(self):
@@ -106,43 +460,399 @@ class LaTeX_Document:
 
 
 
+    output_rexp = re.compile(r'^Output written on (.*) \((\d+) pages?, (\d+) bytes\)')
+
+    def _output_from_log(self, log):
+        """
+        Returns (pages, bytes) from the "Output written on" line
+        of ``log``, or (None, None).
+        """
+        for line in (log or '').splitlines():
+            output = self.output_rexp.match(line)
+            if output is not None:
+                return int(output.group(2)), int(output.group(3))
+        return None, None
+
+    def _from_cache(self, extra_assets):
+        """
+        Look up this document in the cache; on a hit, the output
+        and log are taken from the cache and True is returned.
+        """
+        self._cache_key = None
+        if self.cache is None:
+            return False
+        self._cache_key = self.source_digest(extra_assets)
+        if self._src_file is None:
+            self._new_source_file()
+        # a link in the workspace: the cache entry may be evicted any time.
+        hit = self.cache.get(self._cache_key, os.path.splitext(
+            self._src_file.name)[0] + u'.pdf')
+        if hit is None:
+            return False
+        self._out_file, self._log = hit
+        self._result.cached = True
+        self._result.pages, self._result.output_bytes = \
+            self._output_from_log(self._log)
+        self._compiled = True
+        return True
+
+    def _prepare(self, extra_assets):
+        """
+        Create the source file and make the assets available: from the
+        asset store, or copied next to it.  Returns the working
+        directory, the source file name and the engine environment.
+        """
+        if self._streamed is None:
+            self._new_source_file()
+        else:
+            self._discard_output()
+        working_dir, src_name = os.path.split( self._src_file.name )
+        started = time.time()
+        env = None
+        if self.asset_store is not None:
+            if extra_assets:
+                env = self.asset_store.environ(extra_assets)
+        else:
+            for filename in extra_assets:
+                shutil.copy(filename, working_dir)
+        self._result.asset_time = time.time() - started
+        build_key = self._build_key()
+        if build_key is not None:
+            self._result.restored = self.build_store.restore(
+                build_key, os.path.splitext(self._src_file.name)[0])
+        return working_dir, src_name, env
+
+    def _engine_args(self, src_name, use_format=True, env=None,
+                     deadline=None):
+        """
+        Write the source file, and return the engine arguments and
+        environment (based on ``env``) to compile it.  If a dumped
+        format for the preamble is available (or can be dumped before
+        ``deadline``), only the document body is written.
+        """
+        args = shlex.split(self.latex_command)
+        result = self._result
+        result.format = None
+        result.passes = 0
+        result.pass_times = []
+        if self._streamed is not None:
+            return args + [src_name], env     # already written
+        source = self.source
+        if use_format and self.format_cache is not None:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+            found = self.format_cache.get(source, self.latex_command,
+                                          timeout)
+            if found is not None:
+                result.format, source = found
+                args.append(u'-fmt=%s' % result.format)
+                env = self.format_cache.environ(env)
+        self._src_file.seek(0)
+        self._src_file.truncate()
+        self._src_file.write(source.encode('utf-8', 'replace'))
+        self._src_file.flush()
+        return args + [src_name], env
+
+    def _scan_output(self, output_lines, working_dir, result, started):
+        """
+        Process the output of one engine pass, begun at ``started``.
+        Returns (result, rerun); ``result`` is passed through unchanged
+        if the pass did not report any output.
+        """
+        seconds = time.time() - started
+        self._result.passes += 1
+        self._result.pass_times.append(seconds)
+        rerun = False
+        for line in output_lines:
+            # maybe lowercase? maybe no whitespace
+            if ' Rerun ' in line:
+                rerun = True
+
+            output = self.output_rexp.match(line)
+            if output is not None:
+                filename, pages, bytes = output.groups()
+                # note that pages and bytes are strings.
+                result = pages != '0'
+                self._result.pages = int(pages)
+                self._result.output_bytes = int(bytes)
+                self._out_file = os.path.join(working_dir, filename)
+        self._log = ''.join(output_lines)
+        hooks.compile_pass.send(self, result=self._result, seconds=seconds)
+        return result, rerun
+
+    def _aux_state(self):
+        """
+        Return a dict of {extension: digest} for the auxiliary files
+        of the current job; missing files have a digest of None.
+        """
+        basename = os.path.splitext(self._src_file.name)[0]
+        state = {}
+        for extension in self.aux_extensions:
+            try:
+                with open(basename + extension, 'rb') as f:
+                    state[extension] = hashlib.sha1(f.read()).hexdigest()
+            except (IOError, OSError):
+                state[extension] = None
+        return state
+
+    def _check_rerun(self, rerun, aux_state):
+        """
+        Decide whether another pass is required after the one that just
+        finished.  A pass is only repeated while the auxiliary files are
+        still changing: a change to the .aux file must be confirmed by a
+        rerun message from the engine; changes to the other files (which
+        LaTeX does not warn about) are enough by themselves.
+        Returns (rerun, new_aux_state).
+        """
+        new_state = self._aux_state()
+        changed = [extension for extension in self.aux_extensions
+                   if new_state[extension] != aux_state[extension]]
+        if not changed:
+            rerun = False
+        elif changed != [u'.aux']:
+            rerun = True
+        if self._result.passes >= self.max_passes:
+            rerun = False
+        return rerun, new_state
+
+    def _from_service(self, header, pdf_data):
+        """
+        Take the output and log from a ``latex.daemon`` response.
+        The PDF is written next to a local copy of the source, so that
+        the usual cleanup applies.
+        """
+        if self._streamed is None:
+            self._new_source_file()
+            self._src_file.write(self.source.encode('utf-8', 'replace'))
+            self._src_file.flush()
+        else:
+            self._discard_output()
+        self._log = header['log']
+        result = self._result
+        result.service = True
+        result.aborted = header.get('aborted')
+        result.passes = header['passes']
+        result.pass_times = header.get('pass_times', [])
+        result.pages, result.output_bytes = self._output_from_log(self._log)
+        if pdf_data is not None:
+            self._out_file = os.path.splitext(self._src_file.name)[0] + u'.pdf'
+            with open(self._out_file, 'wb') as f:
+                f.write(pdf_data)
+        return header['result']
+
+    def _build_key(self):
+        if self.build_store is None or self.build_id is None:
+            return None
+        return self.build_store.key(self.build_id, self.latex_command)
+
+    def _keep_build(self, result):
+        """
+        Keep the auxiliary files for the next compile of this build;
+        after a failure, forget them, in case they are the cause.
+        """
+        build_key = self._build_key()
+        if build_key is None:
+            return
+        if result:
+            self.build_store.save(build_key,
+                                  os.path.splitext(self._src_file.name)[0])
+        else:
+            self.build_store.discard(build_key)
+
+    def _store(self, result):
+        if result and self._cache_key is not None:
+            self.cache.put(self._cache_key, self._out_file, self._log)
+
+    def engine_limits(self):
+        """
+        Return the resource limits for the engine, for run_engine().
+        """
+        limits = {}
+        if resource is None:
+            return limits
+        if self.cpu_limit is not None:
+            limits[resource.RLIMIT_CPU] = int(self.cpu_limit)
+        if self.memory_limit is not None:
+            limits[resource.RLIMIT_AS] = int(self.memory_limit)
+        if self.max_output_bytes is not None:
+            limits[resource.RLIMIT_FSIZE] = int(self.max_output_bytes)
+        return limits
+
+    def _deadline(self):
+        if self.timeout is None:
+            return None
+        return time.time() + self.timeout
+
+    def _engine_options(self, deadline):
+        """
+        The keyword arguments for run_engine(): the time left until
+        ``deadline`` and the limits.
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise EngineAborted('timeout', [])
+        return {
+            'timeout': timeout,
+            'limits': self.engine_limits(),
+            'max_output_bytes': self.max_output_bytes,
+        }
+
+    def _aborted(self, error):
+        self._result.aborted = error.reason
+        self._log = ''.join(error.output) + \
+            u'\n! Compile stopped (%s).\n' % error.reason
+        self._out_file = None   # anything an earlier pass wrote is stale
+        return False
+
+    def _begin(self):
+        self._result = CompileResult()
+        hooks.compile_started.send(self, result=self._result)
+        return time.time()
+
+    def _finish(self, started, success, error=None):
+        result = self._result
+        result.success = bool(success)
+        result.log = self._log
+        result.total_time = time.time() - started
+        hooks.compile_finished.send(self, result=result, error=error)
+        return result
+
     def compile(self, force=False, extra_assets=[]):
+        """
+        Compile the document, unless that is already done (or ``force``
+        is True), and return the CompileResult.
+        """
         if not force and self._compiled:
+            return self._result
+        started = self._begin()
+        try:
+            success = self._compile(extra_assets)
+        except Exception as e:
+            self._finish(started, False, e)
+            raise
+        return self._finish(started, success)
+
+    def _compile(self, extra_assets):
+        deadline = self._deadline()
+        if self._from_cache(extra_assets):
             return True
-        self._src_file = NamedTemporaryFile(suffix=u'.tex')
-        self._src_file.write(self.source.encode('utf-8', 'replace'))
-        self._src_file.flush()
-        cmd = u'pdflatex -interaction=nonstopmode "%s"' % self._src_file.name
-        working_dir = os.path.split( self._src_file.name )[0]
-        current_dir = os.getcwd()
-        for filename in extra_assets:
-            shutil.copy(filename, working_dir)
-        os.chdir( working_dir )
+        if self.compile_socket:
+            from .daemon import CompileServiceTimeout, submit
+            # busy, failed or unreachable: the document is not compiled.
+            try:
+                response = submit(
+                    self.compile_socket, self.source, extra_assets,
+                    self.timeout)
+            except CompileServiceTimeout:
+                self._compiled = True
+                return self._aborted(EngineAborted('timeout', []))
+            self._compiled = True
+            result = self._from_service(*response)
+            self._store(result)
+            return result
+        working_dir, src_name, asset_env = self._prepare(extra_assets)
+        try:
+            failed_format = None
+            for use_format in (True, False):
+                args, env = self._engine_args(src_name, use_format,
+                                              asset_env, deadline)
+                result = False
+                aux_state = self._aux_state()
+                while True:
+                    started = time.time()
+                    output_lines = run_engine(
+                        args, working_dir, env,
+                        **self._engine_options(deadline))
+                    result, rerun = self._scan_output(output_lines,
+                                                      working_dir, result,
+                                                      started)
+                    rerun, aux_state = self._check_rerun(rerun, aux_state)
+                    if not rerun:
+                        break
+                if result or self._result.format is None:
+                    break
+                failed_format = self._result.format
+            if result and failed_format is not None:
+                # the document is fine without it, so the format is broken.
+                self.format_cache.mark_failed(failed_format)
+            self._keep_build(result)
+            self._store(result)
+            return result
+        except EngineAborted as e:
+            return self._aborted(e)
+        finally:
+            self._compiled = True
+
+    async def compile_async(self, force=False, extra_assets=[]):
+        """
+        Same as compile(), but awaits the TeX process instead of
+        blocking the calling thread.
+        """
+        if not force and self._compiled:
+            return self._result
+        started = self._begin()
+        try:
+            success = await self._compile_async(extra_assets)
+        except Exception as e:
+            self._finish(started, False, e)
+            raise
+        return self._finish(started, success)
+
+    async def _compile_async(self, extra_assets):
+        deadline = self._deadline()
+        if self._from_cache(extra_assets):
+            return True
+        if self.compile_socket:
+            from .daemon import CompileServiceTimeout, submit_async
+            # busy, failed or unreachable: the document is not compiled.
+            try:
+                response = await submit_async(
+                    self.compile_socket, self.source, extra_assets,
+                    self.timeout)
+            except CompileServiceTimeout:
+                self._compiled = True
+                return self._aborted(EngineAborted('timeout', []))
+            self._compiled = True
+            result = self._from_service(*response)
+            self._store(result)
+            return result
+        working_dir, src_name, asset_env = self._prepare(extra_assets)
         try:
-            result = False
-            output_rexp = re.compile(r'^Output written on (.*) \((\d+) pages?, (\d+) bytes\)')
-            while True:
-                rerun = False
-                output_lines = os.popen(cmd, 'r').readlines()
-
-                for line in output_lines:
-                    # maybe lowercase? maybe no whitespace
-                    if ' Rerun ' in line:
-                        rerun = True
-
-                    output = output_rexp.match(line)
-                    if output is not None:
-                        filename, pages, bytes = output.groups()
-                        # note that pages and bytes are strings.
-                        result = pages != '0'
-                        self._out_file = os.path.join(working_dir, filename)
-                self._log = ''.join(output_lines)
-                if not rerun:
+            failed_format = None
+            for use_format in (True, False):
+                # a format may have to be dumped first: not on the loop.
+                args, env = await asyncio.get_event_loop().run_in_executor(
+                    None, self._engine_args, src_name, use_format,
+                    asset_env, deadline)
+                result = False
+                aux_state = self._aux_state()
+                while True:
+                    started = time.time()
+                    output_lines = await run_engine_async(
+                        args, working_dir, env,
+                        **self._engine_options(deadline))
+                    result, rerun = self._scan_output(output_lines,
+                                                      working_dir, result,
+                                                      started)
+                    rerun, aux_state = self._check_rerun(rerun, aux_state)
+                    if not rerun:
+                        break
+                if result or self._result.format is None:
                     break
+                failed_format = self._result.format
+            if result and failed_format is not None:
+                # the document is fine without it, so the format is broken.
+                self.format_cache.mark_failed(failed_format)
+            self._keep_build(result)
+            self._store(result)
             return result
+        except EngineAborted as e:
+            return self._aborted(e)
         finally:
             self._compiled = True
-            os.chdir( current_dir)  # restore working folder
 
 
     def preview(self, application=None, wait=False):
@@ -165,7 +875,22 @@ class LaTeX_Document:
         if self._out_file is None or not os.path.exists(self._out_file):
             #print >> sys.stderr, 'WARNING: Output file %r does not exist' % self._out_file
             return None
-        return open(self._out_file, 'rb').read()
+        with open(self._out_file, 'rb') as f:
+            return f.read()
+
+    def open_output(self, cleanup=False):
+        """
+        Returns an open (binary) file for the PDF, or None if there is no
+        output; the caller must close it.  The handle stays valid until
+        closed, even after ``cleanup()`` on POSIX systems.  If ``cleanup``
+        is True, the temporary files are removed when it is closed.
+        """
+        if not self._compiled:
+            self.compile()
+        if self._out_file is None or not os.path.exists(self._out_file):
+            return None
+        return OutputFile(self._out_file,
+                          on_close=self.cleanup if cleanup else None)
 
     @property
     def filename(self):
@@ -181,11 +906,11 @@ class LaTeX_Document:
         """
         Return the current source
         """
-        return "{}".format(self)
+        return self.render_src()
 
     @source.setter
     def source(self, value):
-        self.full_src = value
+        self.set_full_src(value)
 
 
     @property
@@ -198,10 +923,212 @@ class LaTeX_Document:
         return self._log
 
 
-    def __del__(self):
-        if self._src_file is not None:
-            # assume all files with the same base name as the src have been
-            # created by this process, and delete them.
-            for fn in glob( os.path.splitext(self._src_file.name)[0] + u'.*' ):
-                if not fn.endswith('.tex'):
-                    os.remove( fn )
+    @property
+    def passes(self):
+        """
+        The number of engine passes used by the last compile
+        (0 if the output came from the cache).
+        """
+        if self._result is None:
+            return 0
+        return self._result.passes
+
+
+    @property
+    def pages(self):
+        """
+        The page count of the output, or None if there is no output.
+        """
+        if self._result is None:
+            return None
+        return self._result.pages
+
+
+    @property
+    def result(self):
+        """
+        The CompileResult of the last compile, or None.
+        """
+        return self._result
+
+
+    def cleanup(self):
+        """
+        Remove the workspace of the last compile.  Cached output
+        is not touched.
+        """
+        src_file, self._src_file = self._src_file, None
+        workspace, self._workspace = self._workspace, None
+        if self._streamed is not None:
+            # a streamed source goes with its file.
+            self._streamed = None
+            self._streamed_lost = True
+        if src_file is None:
+            return
+        src_file.close()
+        workspace.cleanup()
+        if self._out_file is not None and \
+                not os.path.exists(self._out_file):
+            self._out_file = None
+            self._compiled = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+
+class DocumentTemplate(object):
+    """
+    DocumentTemplate(title=None,
+        author=None,
+        date=None,
+        packages={},
+        preamble_extras=None,
+        document_class=LaTeX_Document
+        )
+
+    The part shared by documents that differ only in their body: the
+    header (the document class, packages, preamble and title) is
+    rendered once, when the template is made.  Templates are immutable
+    and hashable; templates with equal headers are equal.
+
+    Useful methods:
+        * document(body)    -- returns a new document (of ``document_class``)
+        * render(body)      -- returns the source for ``body``
+        * header            -- the rendered header
+    """
+    def __init__(self, title=None, author=None, date=None, packages={},
+                 preamble_extras=None, document_class=None):
+        if document_class is None:
+            document_class = LaTeX_Document
+        prototype = document_class(None, title, author, date,
+                                   packages, preamble_extras)
+        self._document_class = document_class
+        self._header = prototype.render_header()
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def document_class(self):
+        return self._document_class
+
+    def __eq__(self, other):
+        if not isinstance(other, DocumentTemplate):
+            return NotImplemented
+        return (self._document_class, self._header) == \
+            (other._document_class, other._header)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self._document_class, self._header))
+
+    def __repr__(self):
+        return '<DocumentTemplate %s>' % hashlib.sha1(
+            self._header.encode('utf-8')).hexdigest()[:12]
+
+    def render(self, body):
+        return u''.join([self._header, "{}".format(body), DOCUMENT_END])
+
+    def document(self, body):
+        doc = self._document_class()
+        doc.set_full_src(self.render(body))
+        return doc
+
+
+#######################
+
+
+# the page styles that number pages, made empty; see merge_source().
+NO_PAGE_NUMBERS = u'\\makeatletter\\let\\ps@plain\\ps@empty\\makeatother' \
+    u'\\pagestyle{empty}\n'
+
+
+def without_page_numbers(source):
+    """
+    Return ``source`` with its pages left unnumbered, so that they can
+    be numbered when merged (see ``merge_source()``).
+    """
+    return source.replace(u'\\begin{document}',
+                          u'\\begin{document}\n' + NO_PAGE_NUMBERS, 1)
+
+
+def merge_source(filenames, pagecommand=None):
+    """
+    Return the source of a document that concatenates the PDF files
+    ``filenames`` (which must be given to ``compile()`` as extra assets).
+    ``pagecommand`` is run on every page; ``\\thispagestyle{plain}``
+    numbers the pages of the merged document.
+    """
+    options = u'pages=-,fitpaper'
+    if pagecommand is not None:
+        options += u',pagecommand={%s}' % pagecommand
+    results = u'\\documentclass{article}\n'
+    results += u'\\usepackage{pdfpages}\n'
+    results += u'\\begin{document}\n'
+    for filename in filenames:
+        results += u'\\includepdf[%s]{%s}\n' % (
+            options, os.path.basename(filename))
+    results += u'\\end{document}\n'
+    return results
+
+
+#######################
+
+BatchResult = namedtuple('BatchResult',
+                         'index document result log error')
+BatchResult.__doc__ = """
+The outcome of one document in ``compile_many()``: ``result`` is the
+return value of ``compile()`` and ``error`` is the exception raised
+while compiling (or ``None``).
+"""
+
+
+def _compile_one(index, document, compile_kwargs):
+    try:
+        result = document.compile(**compile_kwargs)
+    except Exception as e:
+        return BatchResult(index, document, False, document.log, e)
+    return BatchResult(index, document, result, document.log, None)
+
+
+def _iter_results(executor, futures, ordered):
+    try:
+        if ordered:
+            for future in futures:
+                yield future.result()
+        else:
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def compile_many(documents, max_workers=None, ordered=True, **kwargs):
+    """
+    Compile each of ``documents`` (LaTeX_Document instances) on a pool
+    of at most ``max_workers`` threads; each thread drives its own TeX
+    process, so this uses as many cores as there are workers.  Any
+    extra keyword arguments are passed to ``compile()``.
+
+    Returns an iterator of ``BatchResult``, in the order of
+    ``documents`` if ``ordered`` is True, otherwise as each job
+    finishes.  A failing document is reported in its result and
+    does not stop the rest of the batch.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(_compile_one, index, document, kwargs)
+               for index, document in enumerate(documents)]
+    return _iter_results(executor, futures, ordered)
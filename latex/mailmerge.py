@@ -0,0 +1,215 @@
+"""
+Mail merge: many records (letters, certificates, invoices, ...) compiled
+in one TeX run, then split into a PDF per record.
+
+A record is marked at the start of its first page: the marker clears
+the page and writes the number of pages shipped out so far to the
+terminal, where it ends up in the log.  The page ranges are read back
+from the log (so they survive the PDF cache and the compile service),
+and the output is split with pypdf (or PyPDF2>=2.0), which must be
+installed.
+
+    from latex.latex_document import DocumentTemplate
+    from latex.mailmerge import mail_merge
+
+    template = DocumentTemplate(packages={'geometry': 'margin=1in'})
+    results = mail_merge(template, customers, render_letter, 'letters/',
+                         filename=lambda index, customer: customer.slug)
+
+With ``batch_size``, the records are compiled in several documents of
+(at most) that many records, in parallel.  The source of each document
+is streamed to its file, unless the document class has a format cache:
+then it is built in memory (a batch at a time), so that the shared
+preamble can be dumped.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+from collections import namedtuple
+from tempfile import mkstemp
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    try:
+        from PyPDF2 import PdfReader, PdfWriter
+    except ImportError:
+        PdfReader = PdfWriter = None
+
+from .formats import split_preamble
+from .latex_document import compile_many
+
+#######################
+
+# counts the pages shipped out; atbegshi is part of every TeX
+# distribution, and a stub over the kernel hooks in recent ones.
+MERGE_PREAMBLE = u"""\\usepackage{atbegshi}
+\\makeatletter
+\\newcount\\mailmerge@shipped
+\\AtBeginShipout{\\global\\advance\\mailmerge@shipped\\@ne}
+\\newcommand\\mailmergemark[1]{\\clearpage
+  \\typeout{mailmerge: #1 \\the\\mailmerge@shipped}}
+\\makeatother
+"""
+MARKER_REXP = re.compile(r'^mailmerge: (\d+|end) (\d+)\s*$', re.MULTILINE)
+
+MergeResult = namedtuple('MergeResult', 'index record filename pages error')
+MergeResult.__doc__ = """
+The outcome of one record in ``mail_merge()``: ``filename`` is the
+path of its PDF and ``pages`` its page count, or, if its batch failed,
+``filename`` is None and ``error`` says why.
+"""
+
+
+class MailMergeError(RuntimeError):
+    """
+    A merged document could not be split into records.
+    """
+
+
+#######################
+
+
+def merge_header(template):
+    """
+    Return the header of ``template`` (a DocumentTemplate) with the
+    record markers added to its preamble.
+    """
+    parts = split_preamble(template.header)
+    if parts is None:
+        raise ValueError('the template has no \\begin{document}')
+    return parts[0] + MERGE_PREAMBLE + parts[1]
+
+
+def iter_merge_source(header, bodies, reset_page=True):
+    """
+    Yield the source of a document with each of ``bodies`` as a record.
+    With ``reset_page``, each record starts at page 1.
+    """
+    yield header
+    for index, body in enumerate(bodies):
+        yield u'\\mailmergemark{%d}\n' % index
+        if reset_page:
+            yield u'\\setcounter{page}{1}\n'
+        yield u'%s\n' % body
+    yield u'\\mailmergemark{end}\n\\end{document}\n'
+
+
+def page_ranges(log, count):
+    """
+    Return the page range of each of ``count`` records, as a list of
+    (start, stop) page indexes, from the markers in ``log``.
+    """
+    marks = dict(MARKER_REXP.findall(log or u''))
+    try:
+        starts = [int(marks['%d' % index]) for index in range(count)]
+        starts.append(int(marks['end']))
+    except KeyError as e:
+        raise MailMergeError('no marker for record %s in the log' % e)
+    return [(starts[index], starts[index + 1]) for index in range(count)]
+
+
+def split_pdf(pdf_filename, ranges, filenames):
+    """
+    Write the pages ``ranges[i]`` of ``pdf_filename`` to ``filenames[i]``.
+    """
+    if PdfReader is None:
+        raise ImportError('splitting a mail merge requires pypdf')
+    reader = PdfReader(pdf_filename)
+    for (start, stop), filename in zip(ranges, filenames):
+        writer = PdfWriter()
+        for index in range(start, stop):
+            writer.add_page(reader.pages[index])
+        # written aside and renamed, so a PDF is never seen half done.
+        fd, tmp_name = mkstemp(suffix='.tmp',
+                               dir=os.path.dirname(filename) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                writer.write(f)
+            os.rename(tmp_name, filename)
+        except Exception:
+            os.remove(tmp_name)
+            raise
+
+
+def _default_filename(index, record):
+    return 'record-%05d.pdf' % index
+
+
+def mail_merge(template, records, render, output_dir, filename=None,
+               batch_size=None, max_workers=None, reset_page=True,
+               **kwargs):
+    """
+    Write a PDF in ``output_dir`` for each of ``records``, whose LaTeX
+    body is given by ``render(record)``, with the header of ``template``
+    (a DocumentTemplate).  ``filename(index, record)`` gives the name
+    of each PDF (by default, record-00000.pdf, ...); a missing .pdf
+    extension is added.
+
+    All the records are compiled as one document, or, with
+    ``batch_size``, as several documents of that many records, on at
+    most ``max_workers`` threads (see ``compile_many()``, which is
+    passed any extra keyword arguments).
+
+    Returns a list of MergeResult, in the order of ``records``.  Records
+    in a batch that fails are reported in their results, and do not stop
+    the others.
+    """
+    if PdfReader is None:
+        raise ImportError('mail_merge() requires pypdf (or PyPDF2>=2.0)')
+    if filename is None:
+        filename = _default_filename
+    records = list(records)
+    if not batch_size:
+        batch_size = max(len(records), 1)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    header = merge_header(template)
+
+    batches = []
+    docs = []
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        doc = template.document_class()
+        chunks = iter_merge_source(
+            header, (render(record) for record in batch), reset_page)
+        if doc.format_cache is not None:
+            # streamed sources are not compiled against formats.
+            doc.set_full_src(u''.join(chunks))
+        else:
+            doc.write_source(chunks)
+        batches.append((start, batch))
+        docs.append(doc)
+
+    results = [None] * len(records)
+    for outcome in compile_many(docs, max_workers=max_workers,
+                                ordered=False, **kwargs):
+        start, batch = batches[outcome.index]
+        names = []
+        for offset, record in enumerate(batch):
+            name = filename(start + offset, record)
+            if not name.lower().endswith('.pdf'):
+                name += '.pdf'
+            names.append(os.path.join(output_dir, name))
+        error = outcome.error
+        if error is None and not outcome.result:
+            error = MailMergeError('compile failed:\n%s' % outcome.log)
+        if error is None:
+            try:
+                ranges = page_ranges(outcome.log, len(batch))
+                split_pdf(outcome.document._out_file, ranges, names)
+            except Exception as e:
+                error = e
+        outcome.document.cleanup()
+        for offset, record in enumerate(batch):
+            if error is None:
+                result = MergeResult(start + offset, record, names[offset],
+                                     ranges[offset][1] - ranges[offset][0],
+                                     None)
+            else:
+                result = MergeResult(start + offset, record, None, None,
+                                     error)
+            results[start + offset] = result
+    return results
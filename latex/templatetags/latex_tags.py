@@ -0,0 +1,21 @@
+"""
+Template filters for LaTeX templates.  Add 'latex' to INSTALLED_APPS, and
+
+    {% load latex_tags %}
+    {{ value|latex_escape }}
+"""
+from django import template
+from django.utils.safestring import mark_safe
+
+from ..utils import safe_text_specials
+
+register = template.Library()
+
+
+@register.filter
+def latex_escape(value):
+    """
+    Escape the LaTeX special characters in ``value``.  The result is
+    marked safe, so HTML autoescaping does not mangle it.
+    """
+    return mark_safe(safe_text_specials("{}".format(value)))
@@ -1,35 +1,287 @@
 #######################
 from __future__ import print_function, unicode_literals
 
+import re
+import threading
+from collections import Counter
+
 #######################
 
+SPECIAL_MAP = (
+    ('\\',  '\\textbackslash '), 
+    ('&', '\\&'),
+    ('%', '\\%'),
+    ('$', '\\$'),
+    ('#', '\\#'),
+    ('_', '\\_'),
+    ('{', '\\{'),
+    ('}', '\\}'),
+    ('~', '\\textasciitilde '),
+    ('^', '\\textasciicircum '),
+    )
+
+
 def safe_text_specials(s):
     """
     Given a string ``s``, return a new string with any of the latex
     special characters escaped.
     """
-    special_map = (
-        ('\\',  '\\textbackslash '), 
-        ('&', '\\&'),
-        ('%', '\\%'),
-        ('$', '\\$'),
-        ('#', '\\#'),
-        ('_', '\\_'),
-        ('{', '\\{'),
-        ('}', '\\}'),
-        ('~', '\\textasciitilde '),
-        ('^', '\\textasciicircum '),
-        )
-    for src, dst in special_map:
+    # on short cells, a chain of replace() beats str.translate() and
+    # any regular expression.
+    for src, dst in SPECIAL_MAP:
         s = s.replace(src, dst)
     return s
 
 
-def latex_fixes(text):
+def _is_queryset(value):
+    # duck-typed, so that this module does not need Django.
+    return hasattr(value, 'values_list') and hasattr(value, '__iter__')
+
+
+def escape_all(value, wrap=None):
+    """
+    Escape every string in ``value`` with safe_text_specials():
+    strings, the values of dicts, and the items of lists, tuples, sets
+    and querysets (e.g., a flat values_list()), nested to any depth.
+    Dicts, lists, tuples and sets keep their type; querysets become
+    lists.  Anything else (bytes, generators, paginator pages, ...) is
+    returned unchanged.  If given, ``wrap`` is applied to each escaped
+    string.
+    """
+    if isinstance(value, str):
+        value = safe_text_specials(value)
+        if wrap is not None:
+            value = wrap(value)
+        return value
+    if isinstance(value, dict):
+        return dict((k, escape_all(v, wrap)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return type(value)(escape_all(v, wrap) for v in value)
+    if _is_queryset(value):
+        return [escape_all(v, wrap) for v in value]
+    return value
+
+
+def _safe_cut(text, pattern):
+    """
+    Return the largest index of ``text`` before which the occurrences
+    of ``pattern`` cannot depend on what follows ``text``: no occurrence
+    spans it, and no occurrence could start at or after it.
+    """
+    length = len(pattern)
+    cut = len(text) - length + 1
+    while cut > 0:
+        # an occurrence that starts before ``cut`` and ends after it.
+        start = text.find(pattern, max(cut - length + 1, 0),
+                          cut + length - 1)
+        if start == -1:
+            break
+        cut = start
+    return max(cut, 0)
+
+
+class FixupPipeline(object):
+    """
+    FixupPipeline()
+
+    A registry of named text fix-up rules, applied in registration
+    order, each to the output of the ones before it.  Literal string
+    replacements are done with str.replace(); each run of consecutive
+    regular expression rules (or rules with a function as replacement)
+    is compiled into one regular expression and applied in a single
+    scan, in which the first registered wins where several rules of the
+    run match at the same position.
+
+    Useful methods:
+        * register(name, pattern, replacement, ...)
+        * unregister(name)
+        * apply(text)
+        * iter_apply(chunks)    -- for text given as an iterable of chunks
+
+    ``counts`` holds the number of replacements made by each rule.
+    """
+    def __init__(self):
+        self._rules = []
+        self._stages = None
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def register(self, name, pattern, replacement, regex=False,
+                 max_length=None):
+        """
+        Add (or replace) the rule ``name``.  ``pattern`` is a literal
+        string, or a regular expression if ``regex`` is True; regular
+        expressions must give ``max_length``, the longest text they can
+        match (lookarounds included), so that chunked text can be fixed.
+        ``replacement`` is a string, or a function of the match object.
+        """
+        if regex:
+            if max_length is None:
+                raise ValueError('regex rules require a max_length')
+        else:
+            max_length = len(pattern)
+        with self._lock:
+            self._rules = [rule for rule in self._rules if rule[0] != name]
+            self._rules.append((name, pattern, replacement, regex,
+                                max_length))
+            self._stages = None
+
+    def unregister(self, name):
+        with self._lock:
+            self._rules = [rule for rule in self._rules if rule[0] != name]
+            self._stages = None
+
+    def _compile(self):
+        """
+        Returns the list of stages, built once per set of rules: a
+        literal rule is a stage (name, pattern, replacement), a run of
+        other rules a stage (None, regex, replacements, max_length).
+        """
+        stages = self._stages
+        if stages is not None:
+            return stages
+        with self._lock:
+            if self._stages is None:
+                stages = []
+                run = []
+                for rule in self._rules + [None]:
+                    if rule is not None and (rule[3] or callable(rule[2])):
+                        run.append(rule)
+                        continue
+                    if run:
+                        stages.append(self._compile_run(run))
+                        run = []
+                    if rule is not None:
+                        stages.append((rule[0], rule[1], rule[2]))
+                self._stages = stages
+            return self._stages
+
+    def _compile_run(self, rules):
+        regex = re.compile(u'|'.join(
+            u'(?P<_fixup%d>%s)' % (
+                i, rule[1] if rule[3] else re.escape(rule[1]))
+            for i, rule in enumerate(rules)))
+        replacements = dict(
+            (u'_fixup%d' % i, (rule[0], rule[2]))
+            for i, rule in enumerate(rules))
+        max_length = max([rule[4] for rule in rules] + [1])
+        return (None, regex, replacements, max_length)
+
+    def _replace(self, text, name, pattern, replacement):
+        count = text.count(pattern)
+        if not count:
+            return text
+        self.counts[name] += count
+        return text.replace(pattern, replacement)
+
+    def _scan(self, text, regex, replacements, limit=None):
+        """
+        Returns (parts, end, stop): the fixed text up to ``end`` as a
+        list.  Without a ``limit``, the whole of ``text`` is done;
+        otherwise only matches that start before ``limit`` and end
+        before the end of ``text`` (and so cannot depend on what
+        follows) are replaced, and ``stop`` is where the first other
+        match starts.
+        """
+        parts = []
+        end = 0
+        for match in regex.finditer(text):
+            if limit is not None and \
+                    (match.start() >= limit or match.end() == len(text)):
+                return parts, end, match.start()
+            name, replacement = replacements[match.lastgroup]
+            if callable(replacement):
+                replacement = replacement(match)
+            self.counts[name] += 1
+            parts.append(text[end:match.start()])
+            parts.append(replacement)
+            end = match.end()
+        return parts, end, None
+
+    def _scan_all(self, text, regex, replacements):
+        parts, end, stop = self._scan(text, regex, replacements)
+        parts.append(text[end:])
+        return u''.join(parts)
+
+    def apply(self, text):
+        for stage in self._compile():
+            if stage[0] is None:
+                text = self._scan_all(text, stage[1], stage[2])
+            else:
+                text = self._replace(text, *stage)
+        return text
+
+    def iter_apply(self, chunks):
+        """
+        Same as apply(), for text given as an iterable of chunks; yields
+        the fixed text in chunks.  Text that might be the start of a
+        match continuing into the next chunk is held back until then.
+        """
+        chunks = (u"{}".format(chunk) for chunk in chunks)
+        # one generator per stage, as apply() does one pass per stage.
+        for stage in self._compile():
+            if stage[0] is None:
+                chunks = self._iter_scan(chunks, *stage[1:])
+            else:
+                chunks = self._iter_replace(chunks, *stage)
+        return chunks
+
+    def _iter_replace(self, chunks, name, pattern, replacement):
+        tail = u''
+        for chunk in chunks:
+            text = tail + chunk
+            cut = _safe_cut(text, pattern)
+            tail = text[cut:]
+            if cut:
+                yield self._replace(text[:cut], name, pattern, replacement)
+        if tail:
+            yield self._replace(tail, name, pattern, replacement)
+
+    def _iter_scan(self, chunks, regex, replacements, max_length):
+        tail = u''
+        for chunk in chunks:
+            text = tail + chunk
+            limit = len(text) - max_length + 1
+            if limit <= 0:
+                tail = text
+                continue
+            parts, end, stop = self._scan(text, regex, replacements, limit)
+            if stop is None or stop > limit:
+                stop = limit
+            cut = max(end, stop)
+            parts.append(text[end:cut])
+            tail = text[cut:]
+            yield u''.join(parts)
+        if tail:
+            yield self._scan_all(tail, regex, replacements)
+
+
+default_fixups = FixupPipeline()
+# Django's HTML escaping of apostrophes
+default_fixups.register('entities', u'&#39;', u"'")
+# an inter-word, not an inter-sentence, space after abbreviations
+default_fixups.register('sentence-spacing', u'. ', u'.\\ ')
+
+
+def latex_fixes(text, fixups=None):
+    """
+    Apply the fix-up rules of ``fixups`` (by default, ``default_fixups``;
+    register site rules there) to the rendered template ``text``.
+    """
+    if fixups is None:
+        fixups = default_fixups
     result = text
     # this is not really py2 helpful anymore...
     if not isinstance(result, str):
         result = "{}".format(result)
-    result = result.replace(u'&#39;', u"'")
-    result = result.replace(u'. ', u'.\\ ')
-    return result
+    return fixups.apply(result)
+
+
+def iter_latex_fixes(chunks, fixups=None):
+    """
+    Same as latex_fixes(), for text given as an iterable of chunks;
+    yields the fixed text in chunks.
+    """
+    if fixups is None:
+        fixups = default_fixups
+    return fixups.iter_apply(chunks)
@@ -0,0 +1,58 @@
+"""
+Private working directories for compile jobs.
+
+Each job gets a directory of its own, so nothing has to be picked out
+of a shared temporary directory afterwards: cleaning up is removing the
+directory.  Put the workspaces on a tmpfs, such as ``/dev/shm`` on
+Linux, to keep the many small writes of TeX in memory (with the
+LATEX_SCRATCH_DIR environment variable or Django setting, or
+``LaTeX_Document.scratch_dir``).
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import weakref
+
+#######################
+
+
+class Workspace(object):
+    """
+    Workspace(parent=None, prefix='tmp')
+
+    A new directory in ``parent`` (by default, the system temporary
+    directory), removed with all its contents by ``cleanup()``, at the
+    end of a ``with`` block, or at the latest when the workspace is
+    garbage collected or the interpreter exits.
+
+    Useful methods:
+        * filename(name)    -- the path of ``name`` in the workspace
+        * cleanup()
+    """
+    def __init__(self, parent=None, prefix='tmp'):
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        self.name = os.path.basename(self.path)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path,
+                                           True)
+
+    def __repr__(self):
+        return '<Workspace %s>' % self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def exists(self):
+        return self._finalizer.alive
+
+    def cleanup(self):
+        self._finalizer()
@@ -26,7 +26,8 @@ setup(
     author='Dave Gabrielson',
     author_email='Dave@Gabrielson.CA',
     description='Some python code for dealing with LaTeX',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     zip_safe=False,
+    python_requires='>=3.5',
     install_requires=[],
 )
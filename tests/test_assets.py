@@ -0,0 +1,49 @@
+"""
+Tests for latex.assets.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from latex.assets import SEARCH_PATHS, AssetStore
+
+#######################
+
+
+class AssetStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.store = AssetStore(os.path.join(self.directory, 'store'))
+
+    def asset(self, name, data):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def test_same_contents_same_directory(self):
+        first = self.store.add(self.asset('a.otf', b'font'))
+        self.assertEqual(self.store.add(self.asset('a.otf', b'font')), first)
+        self.assertNotEqual(self.store.add(self.asset('a.otf', b'other')),
+                            first)
+
+    def test_environ_covers_fonts(self):
+        filename = self.asset('logo.otf', b'font')
+        env = self.store.environ([filename], {'TFMFONTS': '/fonts'})
+        directory = self.store.add(filename)
+        for name in SEARCH_PATHS:
+            self.assertTrue(env[name].startswith(directory + os.pathsep),
+                            name)
+        self.assertIn('OPENTYPEFONTS', SEARCH_PATHS)
+        self.assertEqual(env['TFMFONTS'],
+                         directory + os.pathsep + '/fonts')
+
+
+if __name__ == '__main__':
+    unittest.main()
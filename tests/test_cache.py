@@ -0,0 +1,54 @@
+"""
+Tests for latex.cache.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from latex.cache import PDFCache
+
+#######################
+
+
+class PDFCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.pdf = os.path.join(self.directory, 'in.pdf')
+        with open(self.pdf, 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def put(self, cache, key, mtime):
+        cache.put(key, self.pdf, u'log of %s' % key)
+        os.utime(os.path.join(cache.directory, key + '.pdf'), (mtime, mtime))
+
+    def test_hit_and_miss(self):
+        cache = PDFCache(os.path.join(self.directory, 'cache'))
+        self.assertIsNone(cache.get('a'))
+        self.put(cache, 'a', 1000)
+        pdf_filename, log = cache.get('a')
+        self.assertEqual(log, u'log of a')
+        with open(pdf_filename, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 1000)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = PDFCache(os.path.join(self.directory, 'cache'),
+                         max_size=2 * 1020)
+        self.put(cache, 'a', 1000)
+        self.put(cache, 'b', 2000)
+        cache.get('a')      # now more recent than b
+        self.put(cache, 'c', 3000)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
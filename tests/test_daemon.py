@@ -0,0 +1,94 @@
+"""
+Tests for latex.daemon, against benchmarks/fake_pdflatex.py.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from latex import daemon
+from latex.latex_document import LaTeX_Document
+
+from .test_document import FAKE_COMMAND, FakeEngineTestCase
+
+#######################
+
+SOURCE = u'\\documentclass{article}\n\\begin{document}\nx\n\\end{document}\n'
+
+
+class CompileServerTest(FakeEngineTestCase):
+    latency = '0.5'
+
+    def setUp(self):
+        FakeEngineTestCase.setUp(self)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.socket_path = os.path.join(directory, 'latex.sock')
+        command, LaTeX_Document.latex_command = \
+            LaTeX_Document.latex_command, FAKE_COMMAND
+        self.addCleanup(setattr, LaTeX_Document, 'latex_command', command)
+        self.server = daemon.CompileServer(self.socket_path, workers=1,
+                                           max_queue=1)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def submit_in_background(self):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            daemon.submit(self.socket_path, SOURCE)))
+        thread.start()
+        self.addCleanup(thread.join)
+        return results
+
+    def wait_for(self, **counts):
+        for i in range(100):
+            stats = daemon.stats(self.socket_path)
+            if all(stats[name] == count for name, count in counts.items()):
+                return
+            time.sleep(0.02)
+        self.fail('service never reached %r' % counts)
+
+    def test_compile(self):
+        header, pdf_data = daemon.submit(self.socket_path, SOURCE)
+        self.assertTrue(header['result'])
+        self.assertEqual(header['passes'], 1)
+        self.assertTrue(pdf_data.startswith(b'%PDF'))
+
+    def test_rejects_jobs_beyond_the_queue(self):
+        first = self.submit_in_background()
+        self.wait_for(running=1)
+        second = self.submit_in_background()
+        self.wait_for(running=1, queued=1)
+        self.assertRaises(daemon.CompileServiceBusy, daemon.submit,
+                          self.socket_path, SOURCE)
+        self.assertEqual(daemon.stats(self.socket_path)['rejected'], 1)
+        # the accepted jobs still complete.
+        self.wait_for(completed=2)
+        time.sleep(0.1)
+        self.assertTrue(first[0][0]['result'])
+        self.assertTrue(second[0][0]['result'])
+
+
+
+class FailedSubmitTest(FakeEngineTestCase):
+
+    def test_document_is_not_compiled(self):
+        doc = self.document(u'Body')
+        doc.compile_socket = os.path.join(tempfile.gettempdir(),
+                                          'no-such-latex.sock')
+        self.assertRaises(EnvironmentError, doc.compile)
+        doc.compile_socket = None
+        # compiled on first use, rather than taken as done.
+        self.assertTrue(doc.pdf_data().startswith(b'%PDF'))
+
+
+if __name__ == '__main__':
+    unittest.main()
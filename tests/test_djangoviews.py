@@ -0,0 +1,323 @@
+"""
+Tests for latex.djangoviews; skipped if Django is not installed.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import concurrent.futures
+import datetime
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import django
+except ImportError:
+    django = None
+
+from .test_document import FAKE_COMMAND, FakeEngineTestCase
+
+#######################
+
+TEMPLATES = {
+    'base.tex': (
+        '\\documentclass{article}{% block pre %}PRE{% endblock %}\n'
+        '\\begin{document}\n{% block body %}default{% endblock %}\n'
+        '{% for x in empty %}{{ x }}{% empty %}none{% endfor %}\n'
+        '\\end{document}\n'),
+    'child.tex': (
+        '{% extends "base.tex" %}'
+        '{% block pre %}{{ block.super }}+child{% endblock %}'
+        '{% block body %}{% for a, b in pairs %}'
+        '{{ forloop.counter }}:{{ a }}={{ b }}'
+        '{% for c in inner reversed %}[{{ forloop.parentloop.counter }}{{ c }}]'
+        '{% endfor %}\n{% endfor %}{% endblock %}'),
+    'list.tex': (
+        '\\documentclass{article}\n\\begin{document}\n'
+        '{{ object_list|length }}/{{ book_list|length }}\n'
+        '{% for book in book_list %}{{ book }}\n{% endfor %}'
+        '\\end{document}\n'),
+    'detail.tex': (
+        '\\documentclass{article}\n\\begin{document}\n'
+        '{{ object.title }}\n\\end{document}\n'),
+}
+
+
+class Meta(object):
+    app_label = 'books'
+    model_name = 'book'
+
+
+class Book(object):
+    _meta = Meta()
+
+    def __init__(self, title, updated=None):
+        self.title = title
+        self.updated = updated
+
+    def __str__(self):
+        return self.title
+
+
+class BookQuerySet(list):
+    """
+    Enough of a queryset for ListView.
+    """
+    model = Book
+
+
+def setUpModule():
+    if django is None:
+        raise unittest.SkipTest('Django is not installed')
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {
+                'autoescape': False,
+                'loaders': [('django.template.loaders.locmem.Loader',
+                             TEMPLATES)],
+            },
+        }])
+        django.setup()
+
+
+class FakeEngineViewMixin(object):
+
+    def get_latex_document(self, source=None):
+        doc = super(FakeEngineViewMixin, self).get_latex_document(source)
+        doc.latex_command = FAKE_COMMAND
+        doc.compile_socket = None
+        return doc
+
+
+class ViewTestCase(FakeEngineTestCase):
+
+    def get(self, view_class, path='/', **extra):
+        from django.test import RequestFactory
+        request = RequestFactory().get(path, **extra)
+        response = view_class.as_view()(request)
+        if getattr(response, 'streaming', False):
+            # reading it to the end closes the PDF, and cleans up.
+            response.pdf = b''.join(response.streaming_content)
+            response.close()
+        return response
+
+
+class IterRenderTemplateTest(unittest.TestCase):
+
+    def test_same_as_render(self):
+        from django.template.loader import get_template
+        from latex.djangoviews import iter_render_template
+        template = get_template('child.tex')
+        context = {'pairs': [(i, 'v%d' % i) for i in range(3000)],
+                   'inner': 'xyz', 'empty': []}
+        chunks = list(iter_render_template(template, context))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), template.render(context))
+
+
+class ConditionalDetailViewTest(ViewTestCase):
+
+    def view_class(self):
+        from latex.djangoviews import LaTeXDetailView
+
+        class BookDetailView(FakeEngineViewMixin, LaTeXDetailView):
+            template_name = 'detail.tex'
+            last_modified_field = 'updated'
+
+            def get_object(self):
+                return Book('Title', datetime.date(2020, 1, 2))
+
+        return BookDetailView
+
+    def test_date_last_modified(self):
+        response = self.get(self.view_class())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Last-Modified'],
+                         'Thu, 02 Jan 2020 00:00:00 GMT')
+
+    def test_if_modified_since(self):
+        response = self.get(
+            self.view_class(),
+            HTTP_IF_MODIFIED_SINCE='Thu, 02 Jan 2020 00:00:00 GMT')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Last-Modified'],
+                         'Thu, 02 Jan 2020 00:00:00 GMT')
+        response = self.get(
+            self.view_class(),
+            HTTP_IF_MODIFIED_SINCE='Wed, 01 Jan 2020 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_none_match(self):
+        etag = self.get(self.view_class())['ETag']
+        response = self.get(self.view_class(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.get(self.view_class(), HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_source_etag(self):
+        from django.utils.http import quote_etag
+        from latex.cache import source_digest
+        response = self.get(self.view_class(), '/?src=1')
+        self.assertEqual(response.status_code, 200)
+        source = response.content.decode('utf-8')
+        self.assertIn('Title', source)
+        self.assertEqual(response['ETag'],
+                         quote_etag(source_digest(source, [], 'source')))
+        self.assertNotEqual(response['ETag'],
+                            self.get(self.view_class())['ETag'])
+        response = self.get(self.view_class(), '/?src=1',
+                            HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class CompileTimeoutViewTest(ViewTestCase):
+    latency = '2'
+
+    def test_timeout(self):
+        from latex.djangoviews import LaTeXDetailView
+
+        class BookDetailView(FakeEngineViewMixin, LaTeXDetailView):
+            template_name = 'detail.tex'
+            compile_timeout = 0.3
+
+            def get_object(self):
+                return Book('Title')
+
+        started = time.time()
+        response = self.get(BookDetailView)
+        self.assertEqual(response.status_code, 504)
+        self.assertLess(time.time() - started, 1.5)
+
+
+class ChunkedListViewTest(ViewTestCase):
+
+    def view_class(self):
+        from latex.djangoviews import LaTeXListView
+
+        class BookListView(FakeEngineViewMixin, LaTeXListView):
+            template_name = 'list.tex'
+            queryset = BookQuerySet(Book('b%d' % i) for i in range(50))
+            chunk_size = 20
+
+        return BookListView
+
+    def test_chunks_hold_their_own_objects(self):
+        from django.test import RequestFactory
+        view = self.view_class()()
+        view.setup(RequestFactory().get('/'))
+        view.object_list = view.get_queryset()
+        sources = view.render_chunks(view.get_context_data())
+        self.assertEqual([source.count('\n') for source in sources],
+                         [24, 24, 14])
+        self.assertEqual([source.split('\n')[2] for source in sources],
+                         ['20/20', '20/20', '10/10'])
+        self.assertIn('b49\n', sources[2])
+        self.assertNotIn('b0\n', sources[2])
+
+    def test_merged_pdf(self):
+        response = self.get(self.view_class())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(response.pdf)
+
+
+
+class FormatCacheViewTest(ViewTestCase):
+
+    def test_format_cache_is_used(self):
+        from latex.djangoviews import LaTeXListView
+        from latex.formats import FormatCache
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+
+        class BookListView(FakeEngineViewMixin, LaTeXListView):
+            template_name = 'list.tex'
+            queryset = BookQuerySet([Book('b')])
+            format_cache = FormatCache(directory, min_uses=1)
+
+        for i in range(3):
+            response = self.get(BookListView)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.pdf)
+        self.assertEqual(BookListView.format_cache.stats()['dumps'], 1)
+        self.assertEqual(BookListView.format_cache.hits, 3)
+
+
+class DeferredListViewTest(ViewTestCase):
+
+    def view_class(self, **attrs):
+        from latex.djangoviews import LaTeXListView
+        gate = self.gate = threading.Event()
+
+        class BookListView(FakeEngineViewMixin, LaTeXListView):
+            template_name = 'list.tex'
+            queryset = BookQuerySet([Book('b')])
+            deferred = True
+
+            def get_latex_document(self, source=None):
+                # the compile starts once the test has the 202.
+                doc = super(BookListView, self).get_latex_document(source)
+                prepare = doc._prepare
+
+                def gated_prepare(extra_assets):
+                    gate.wait(5)
+                    return prepare(extra_assets)
+
+                doc._prepare = gated_prepare
+                return doc
+
+        for name, value in attrs.items():
+            setattr(BookListView, name, value)
+        return BookListView
+
+    def start(self, view_class):
+        from latex.djangoviews import _deferred_jobs
+        response = self.get(view_class)
+        self.assertEqual(response.status_code, 202)
+        job = _deferred_jobs[json.loads(response.content)['job']]
+        self.addCleanup(job.discard)
+        self.assertEqual(response['Location'], '/?job=%s' % job.id)
+        self.gate.set()
+        concurrent.futures.wait([job.future])
+        return job
+
+    def test_pdf_when_done(self):
+        view_class = self.view_class()
+        job = self.start(view_class)
+        response = self.get(view_class, '/?job=%s' % job.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(response.pdf)
+
+    def test_error_when_the_compile_raised(self):
+        view_class = self.view_class(
+            get_extra_assets=lambda view: ['/nonexistent/asset.png'])
+        job = self.start(view_class)
+        self.assertIsInstance(job.future.exception(), OSError)
+        response = self.get(view_class, '/?job=%s' % job.id)
+        self.assertEqual(response.status_code, 500)
+        # and it is not compiled again, without its assets.
+        self.assertFalse(job.doc._compiled)
+
+    def test_busy_when_the_service_was(self):
+        from django.test import RequestFactory
+        from latex.daemon import CompileServiceBusy
+        from latex.djangoviews import DeferredJob
+        future = concurrent.futures.Future()
+        future.set_exception(CompileServiceBusy())
+        view = self.view_class()()
+        view.setup(RequestFactory().get('/'))
+        job = DeferredJob(view.get_latex_document(), future)
+        response = view.get_job_response(job)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+"""
+Tests for latex.latex_document, against benchmarks/fake_pdflatex.py.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import resource
+except ImportError:     # not on Windows
+    resource = None
+
+from latex.cache import PDFCache
+from latex.latex_document import (EngineAborted, LaTeX_Document,
+                                  compile_many, run_engine)
+
+#######################
+
+FAKE_PDFLATEX = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'fake_pdflatex.py')
+FAKE_COMMAND = u'%s %s -interaction=nonstopmode' % (
+    shlex.quote(sys.executable), shlex.quote(FAKE_PDFLATEX))
+
+
+class FakeEngineTestCase(unittest.TestCase):
+    """
+    Compiles with the fake engine, locally, with no latency.
+    """
+    latency = '0'
+
+    def setUp(self):
+        self._environ = os.environ.get('FAKE_PDFLATEX_LATENCY')
+        os.environ['FAKE_PDFLATEX_LATENCY'] = self.latency
+
+    def tearDown(self):
+        if self._environ is None:
+            del os.environ['FAKE_PDFLATEX_LATENCY']
+        else:
+            os.environ['FAKE_PDFLATEX_LATENCY'] = self._environ
+
+    def document(self, body):
+        doc = LaTeX_Document(body)
+        doc.latex_command = FAKE_COMMAND
+        doc.compile_socket = None
+        self.addCleanup(doc.cleanup)
+        return doc
+
+
+#######################
+
+
+class RerunTest(FakeEngineTestCase):
+
+    def test_one_pass_without_references(self):
+        doc = self.document(u'No references.')
+        self.assertTrue(doc.compile())
+        self.assertEqual(doc.passes, 1)
+
+    def test_rerun_until_aux_converges(self):
+        doc = self.document(u'See p.~\\pageref{end}.')
+        result = doc.compile()
+        self.assertTrue(result)
+        # the second pass writes the same .aux, and asks for no rerun.
+        self.assertEqual(result.passes, 2)
+        self.assertEqual(len(result.pass_times), 2)
+
+    def test_max_passes(self):
+        doc = self.document(u'See p.~\\pageref{end}.')
+        doc.max_passes = 1
+        self.assertEqual(doc.compile().passes, 1)
+
+
+class CompileManyTest(FakeEngineTestCase):
+    latency = '0.05'
+
+    def test_concurrent_compiles_keep_their_output(self):
+        docs = [self.document(u'Document %d' % i) for i in range(16)]
+        results = list(compile_many(docs, max_workers=8))
+        self.assertEqual([r.index for r in results], list(range(16)))
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertTrue(result.result, result.log)
+            # the fake engine writes the hash of its source in the PDF.
+            digest = hashlib.sha1(
+                result.document.source.encode('utf-8')).hexdigest()
+            self.assertEqual(result.document.pdf_data().split(b'\n')[1],
+                             b'% ' + digest.encode('ascii'))
+
+    def test_failure_does_not_stop_the_batch(self):
+        docs = [self.document(u'Document %d' % i) for i in range(3)]
+        docs[1].latex_command = u'false'
+        results = list(compile_many(docs, max_workers=2, ordered=False))
+        self.assertEqual(sorted(bool(r.result) for r in results),
+                         [False, True, True])
+
+
+class StreamedSourceTest(FakeEngineTestCase):
+
+    def streamed(self):
+        doc = self.document(None)
+        doc.write_source([u'\\documentclass{article}\n',
+                          u'\\begin{document}\nStreamed\n',
+                          u'\\end{document}\n'])
+        return doc
+
+    def test_str_is_the_streamed_source(self):
+        doc = self.streamed()
+        self.assertIn(u'Streamed', doc.source)
+        self.assertEqual(u'%s' % doc, doc.source)
+        self.assertEqual(doc.render_src(), doc.source)
+
+    def test_compile(self):
+        doc = self.streamed()
+        self.assertTrue(doc.compile())
+        digest = hashlib.sha1(doc.source.encode('utf-8')).hexdigest()
+        self.assertIn(digest.encode('ascii'), doc.pdf_data())
+
+    def test_compile_after_cleanup_raises(self):
+        doc = self.streamed()
+        doc.compile()
+        doc.cleanup()
+        self.assertRaises(ValueError, doc.compile, force=True)
+        doc.set_full_src(u'\\begin{document}\nAgain\n\\end{document}\n')
+        self.assertTrue(doc.compile(force=True))
+
+
+class CacheTest(FakeEngineTestCase):
+
+    def setUp(self):
+        FakeEngineTestCase.setUp(self)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.cache = PDFCache(directory)
+
+    def document(self, body):
+        doc = FakeEngineTestCase.document(self, body)
+        doc.cache = self.cache
+        return doc
+
+    def test_hit_survives_eviction(self):
+        self.assertFalse(self.document(u'Cached').compile().cached)
+        doc = self.document(u'Cached')
+        self.assertTrue(doc.compile().cached)
+        expected = doc.pdf_data()
+        self.cache.clear()
+        self.assertEqual(doc.pdf_data(), expected)
+
+    def test_recompile_does_not_touch_the_entry(self):
+        doc = self.document(None)
+        doc.write_source([u'\\begin{document}\nOne\n\\end{document}\n'])
+        doc.compile()
+        key = doc.source_digest()
+        doc.write_source([u'\\begin{document}\nOne\n\\end{document}\n'])
+        self.assertTrue(doc.compile(force=True).cached)
+        with open(self.cache.get(key)[0], 'rb') as f:
+            expected = f.read()
+        doc.cache = None
+        # a different PDF, written in the same workspace.
+        os.environ['FAKE_PDFLATEX_BYTES'] = '100'
+        self.addCleanup(os.environ.pop, 'FAKE_PDFLATEX_BYTES')
+        self.assertTrue(doc.compile(force=True))
+        self.assertNotEqual(doc.pdf_data(), expected)
+        with open(self.cache.get(key)[0], 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+
+@unittest.skipIf(resource is None, 'no resource limits on this platform')
+class EngineLimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def run_python(self, code, limits):
+        return run_engine([sys.executable, '-c', code], self.directory,
+                          limits=limits)
+
+    def test_file_size_limit(self):
+        args = ['sh', '-c', 'exec head -c 100000 /dev/zero > big']
+        with self.assertRaises(EngineAborted) as cm:
+            run_engine(args, self.directory,
+                       limits={resource.RLIMIT_FSIZE: 1000})
+        self.assertEqual(cm.exception.reason, 'limit')
+
+    def test_limits_are_set_in_the_engine(self):
+        code = ('import resource; '
+                'print(resource.getrlimit(resource.RLIMIT_CPU)[0])')
+        self.assertEqual(self.run_python(code, {resource.RLIMIT_CPU: 7}),
+                         ['7\n'])
+
+    def test_missing_engine(self):
+        lines = run_engine(['no-such-engine'], self.directory,
+                           limits={resource.RLIMIT_CPU: 7})
+        self.assertIn('cannot run no-such-engine', ''.join(lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Tests for latex.formats, against benchmarks/fake_pdflatex.py.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import asyncio
+import shutil
+import tempfile
+import time
+import unittest
+
+from latex.formats import FormatCache, split_format
+
+from .test_document import FakeEngineTestCase
+
+#######################
+
+
+class SplitFormatTest(unittest.TestCase):
+
+    def test_title_goes_with_the_body(self):
+        source = (u'\\documentclass{article}\n\\usepackage{x}\n'
+                  u'\\title{T}\n\\author{A}\n\\begin{document}\nB')
+        self.assertEqual(split_format(source), (
+            u'\\documentclass{article}\n\\usepackage{x}\n',
+            u'\\title{T}\n\\author{A}\n\\begin{document}\nB'))
+
+    def test_no_begin_document(self):
+        self.assertIsNone(split_format(u'\\title{T}'))
+
+
+class FormatCacheTest(FakeEngineTestCase):
+
+    def setUp(self):
+        FakeEngineTestCase.setUp(self)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.formats = FormatCache(directory, min_uses=1, max_seen=2)
+
+    def document(self, body, title=None):
+        doc = FakeEngineTestCase.document(self, body)
+        doc._title = title
+        doc.format_cache = self.formats
+        return doc
+
+    def test_titles_share_a_format(self):
+        for title in (u'One', u'Two'):
+            result = self.document(u'Body', title).compile()
+            self.assertTrue(result)
+            self.assertIsNotNone(result.format)
+        self.assertEqual(self.formats.stats()['dumps'], 1)
+        self.assertEqual(self.formats.hits, 2)
+
+    def test_compile_async(self):
+        doc = self.document(u'Body')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        result = loop.run_until_complete(doc.compile_async())
+        self.assertTrue(result)
+        self.assertIsNotNone(result.format)
+
+    def test_seen_preambles_are_bounded(self):
+        for i in range(5):
+            self.formats.get(u'\\usepackage{p%d}\\begin{document}' % i,
+                             u'pdflatex', timeout=0)
+        self.assertEqual(len(self.formats._seen), 2)
+
+    def test_expired_deadline_does_not_fail_the_preamble(self):
+        source = u'\\usepackage{p}\\begin{document}'
+        self.assertIsNone(self.formats.get(source, u'pdflatex', timeout=0))
+        self.assertEqual(self.formats._failed, set())
+
+    def test_does_not_wait_past_the_deadline_for_a_dump(self):
+        source = u'\\usepackage{p}\\begin{document}'
+        key = self.formats.key(split_format(source)[0], u'pdflatex')
+        uses, key_lock = self.formats._use(key)
+        with key_lock:     # as while another thread dumps it
+            started = time.time()
+            self.assertIsNone(self.formats.get(source, u'pdflatex',
+                                               timeout=0.2))
+            self.assertLess(time.time() - started, 1)
+        self.assertEqual(self.formats.misses, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+"""
+Tests for latex.mailmerge.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import unittest
+
+from latex.mailmerge import MailMergeError, iter_merge_source, page_ranges
+
+#######################
+
+LOG = u"""This is pdfTeX
+mailmerge: 0 0
+[1] [2]
+mailmerge: 1 2
+mailmerge: 2 3
+[3] [4] [5]
+mailmerge: end 6
+Output written on job.pdf (6 pages, 1234 bytes).
+"""
+
+
+class PageRangesTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(page_ranges(LOG, 3), [(0, 2), (2, 3), (3, 6)])
+
+    def test_missing_marker(self):
+        self.assertRaises(MailMergeError, page_ranges, LOG, 4)
+        self.assertRaises(MailMergeError, page_ranges, None, 1)
+
+    def test_source_has_a_marker_per_record(self):
+        source = u''.join(iter_merge_source(u'HEADER\n', [u'a', u'b']))
+        self.assertEqual(source.count(u'\\mailmergemark{'), 3)
+        self.assertTrue(source.startswith(u'HEADER\n\\mailmergemark{0}'))
+        self.assertTrue(source.endswith(u'\\end{document}\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+"""
+Tests for latex.utils.
+"""
+#######################
+from __future__ import print_function, unicode_literals
+
+import random
+import unittest
+
+from latex.utils import (FixupPipeline, escape_all, iter_latex_fixes,
+                         latex_fixes, safe_text_specials)
+
+#######################
+
+
+def reference_safe_text_specials(s):
+    # the original implementation, which the fast one must match.
+    special_map = (
+        ('\\',  '\\textbackslash '), ('&', '\\&'), ('%', '\\%'), ('$', '\\$'),
+        ('#', '\\#'), ('_', '\\_'), ('{', '\\{'), ('}', '\\}'),
+        ('~', '\\textasciitilde '), ('^', '\\textasciicircum '),
+        )
+    for src, dst in special_map:
+        s = s.replace(src, dst)
+    return s
+
+
+def reference_latex_fixes(text):
+    text = text.replace('&#39;', "'")
+    return text.replace('. ', '.\\ ')
+
+
+def random_text(rng, length, alphabet='\\&%$#_{}~^ab .\né—'):
+    return ''.join(rng.choice(alphabet) for i in range(length))
+
+
+#######################
+
+
+class SafeTextSpecialsTest(unittest.TestCase):
+
+    def test_matches_reference(self):
+        rng = random.Random(1234)
+        for i in range(2000):
+            s = random_text(rng, rng.randint(0, 40))
+            self.assertEqual(safe_text_specials(s),
+                             reference_safe_text_specials(s), repr(s))
+
+    def test_plain_text_unchanged(self):
+        self.assertEqual(safe_text_specials('Plain text.'), 'Plain text.')
+
+    def test_backslash_is_not_escaped_twice(self):
+        self.assertEqual(safe_text_specials('\\{'), '\\textbackslash \\{')
+
+
+class EscapeAllTest(unittest.TestCase):
+
+    def test_containers_keep_their_type(self):
+        value = {'a': ['x_1', ('y&', {'z%'})], 'b': 3}
+        self.assertEqual(escape_all(value),
+                         {'a': ['x\\_1', ('y\\&', {'z\\%'})], 'b': 3})
+
+    def test_wrap(self):
+        self.assertEqual(escape_all(['$'], wrap=lambda s: '<%s>' % s),
+                         ['<\\$>'])
+
+    def test_queryset_becomes_list(self):
+        class QuerySet(object):
+            def __iter__(self):
+                return iter(['a_b', 'c'])
+
+            def values_list(self, *fields):
+                return self
+
+        self.assertEqual(escape_all(QuerySet()), ['a\\_b', 'c'])
+
+    def test_other_iterables_unchanged(self):
+        generator = (s for s in ['a_b'])
+        for value in (b'a_b', generator, range(3)):
+            self.assertIs(escape_all(value), value)
+        self.assertEqual(list(generator), ['a_b'])
+
+
+class FixupPipelineTest(unittest.TestCase):
+
+    def test_default_rules_match_reference(self):
+        rng = random.Random(99)
+        alphabet = ['&#39;', '. ', '.', '&', '#', ' ', 'a']
+        for i in range(2000):
+            text = ''.join(rng.choice(alphabet)
+                           for j in range(rng.randint(0, 30)))
+            self.assertEqual(latex_fixes(text), reference_latex_fixes(text),
+                             repr(text))
+
+    def test_literal_rules_apply_in_order(self):
+        fixups = FixupPipeline()
+        fixups.register('a', 'a', 'b')
+        fixups.register('b', 'bb', 'c')
+        self.assertEqual(fixups.apply('ab aab'), 'c cb')
+        self.assertEqual(fixups.counts, {'a': 3, 'b': 2})
+
+    def test_regex_rule_keeps_literal_rules_in_order(self):
+        fixups = FixupPipeline()
+        fixups.register('a', 'a', 'b')
+        fixups.register('b', 'bb', 'c')
+        fixups.register('digits', r'\d', '#', regex=True, max_length=1)
+        self.assertEqual(fixups.apply('ab aab'), 'c cb')
+        self.assertEqual(fixups.apply('ab 1'), 'c #')
+        text = 'ab aab 12 ' * 3
+        expected = fixups.apply(text)
+        for size in range(1, 8):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(''.join(fixups.iter_apply(chunks)), expected,
+                             size)
+
+    def test_regex_rules(self):
+        fixups = FixupPipeline()
+        fixups.register('entities', '&#39;', "'")
+        fixups.register('digits', r'\d+', lambda m: '<%s>' % m.group(),
+                        regex=True, max_length=8)
+        self.assertEqual(fixups.apply('&#39;12 3'), "'<12> <3>")
+        self.assertEqual(fixups.counts, {'entities': 1, 'digits': 2})
+        fixups.unregister('digits')
+        self.assertEqual(fixups.apply('&#39;12'), "'12")
+
+    def test_regex_rules_need_max_length(self):
+        self.assertRaises(ValueError, FixupPipeline().register,
+                          'digits', r'\d+', '', regex=True)
+
+
+class ChunkedFixupsTest(unittest.TestCase):
+
+    def chunked(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_matches_across_chunk_boundaries(self):
+        text = 'Mr. Smith&#39;s car. &#39;. x. ' * 3
+        expected = latex_fixes(text)
+        for size in range(1, len(text) + 1):
+            self.assertEqual(
+                ''.join(iter_latex_fixes(self.chunked(text, size))),
+                expected, size)
+
+    def test_random_chunks(self):
+        rng = random.Random(7)
+        alphabet = ['&#39;', '. ', '.', '&', '#3', ' ', 'a']
+        for i in range(500):
+            text = ''.join(rng.choice(alphabet)
+                           for j in range(rng.randint(0, 30)))
+            size = rng.randint(1, 8)
+            self.assertEqual(
+                ''.join(iter_latex_fixes(self.chunked(text, size))),
+                reference_latex_fixes(text), (text, size))
+
+    def test_self_overlapping_pattern(self):
+        fixups = FixupPipeline()
+        fixups.register('pairs', 'aa', 'X')
+        text = 'aaaaabaaab' * 3
+        for size in range(1, 6):
+            self.assertEqual(
+                ''.join(fixups.iter_apply(self.chunked(text, size))),
+                text.replace('aa', 'X'), size)
+
+    def test_regex_rules_across_chunk_boundaries(self):
+        fixups = FixupPipeline()
+        fixups.register('entities', '&#39;', "'")
+        fixups.register('digits', r'\d+', lambda m: '<%s>' % m.group(),
+                        regex=True, max_length=4)
+        text = 'a 12 &#39;345 b 6&#39;'
+        expected = fixups.apply(text)
+        for size in range(1, len(text) + 1):
+            self.assertEqual(
+                ''.join(fixups.iter_apply(self.chunked(text, size))),
+                expected, size)
+
+
+if __name__ == '__main__':
+    unittest.main()